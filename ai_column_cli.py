@@ -0,0 +1,574 @@
+"""LocalAItable 命令行批处理入口
+
+不依赖Tkinter，可在无图形界面的服务器上(如cron定时任务)运行完整的生成流程：
+读取表格 -> 按模板调用AI生成 -> 清理输出 -> 导出文件。
+
+示例:
+    python ai_column_cli.py data.csv -r 诊断 -r 主诉 -t AI摘要 \\
+        --template 摘要生成 --api-type ollama --model deepseek-r1:14b \\
+        --threads 8 -o result.xlsx
+"""
+import os
+import sys
+import argparse
+import csv
+import time
+from ai_engine import (
+    PRESET_TEMPLATES, GenerationEngine, GenerationJob, AsyncGenerationJob, AdaptiveConcurrency, RateLimiter,
+    RetryPolicy, ProgressMeter, CLEANING_STEPS,
+    load_api_config, load_openai_base_url, load_user_templates, get_template_content, get_template_cleaning,
+    get_template_options, parse_ollama_options, parse_keep_alive, template_columns
+)
+from table_io import read_table, write_table, iter_csv_chunks, append_csv, count_csv_rows, ensure_text_column
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+from checkpoint import (
+    CheckpointWriter, checkpoint_path_for, checkpoint_signature, load_checkpoint, apply_checkpoint
+)
+from batch_job import (
+    OpenAIBatchJob, batch_state_path_for, batch_requests_path_for, load_batch_state, state_batches
+)
+from fingerprints import (
+    fingerprint_path_for, compute_fingerprints, load_fingerprints, save_fingerprints,
+    select_changed_rows, update_fingerprints
+)
+
+
+def resolve_prompt_template(args):
+    """根据命令行参数确定提示词模板内容"""
+    if args.template_file:
+        with open(args.template_file, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+
+    if args.prompt:
+        return args.prompt
+
+    # 先查预设模板，再查用户保存的模板
+    if args.template in PRESET_TEMPLATES:
+        return PRESET_TEMPLATES[args.template]
+    user_templates = load_user_templates(args.templates_path)
+    if args.template in user_templates:
+        return get_template_content(user_templates[args.template])
+
+    raise ValueError(f"未找到模板: {args.template}")
+
+
+def load_saved_template(args):
+    """返回 --template 指定的用户已保存模板数据，不是已保存模板时返回None"""
+    if args.template and args.template not in PRESET_TEMPLATES:
+        return load_user_templates(args.templates_path).get(args.template)
+    return None
+
+
+def resolve_cleaning_steps(args):
+    """确定输出清理步骤：已保存模板使用其保存的开关，再关闭 --no-clean 指定的步骤"""
+    steps = get_template_cleaning(load_saved_template(args))
+    for name in args.no_clean:
+        steps[name] = False
+    return steps
+
+
+def resolve_ollama_options(args):
+    """确定Ollama参数：已保存模板的参数，再用 --ollama-option 覆盖，格式错误时抛出ValueError"""
+    values = get_template_options(load_saved_template(args))
+    for item in args.ollama_options:
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"--ollama-option 格式应为 名称=值: {item}")
+        values[name.strip()] = value
+    return parse_ollama_options(values)
+
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(
+        description="LocalAItable 命令行批处理：为表格批量生成AI内容"
+    )
+    parser.add_argument("input", help="输入的Excel/CSV/Parquet/Feather文件路径")
+    parser.add_argument("-r", "--ref-column", dest="ref_columns", action="append", default=[],
+                        help="引用列，可多次指定；模板中只用 {列名} 占位符时可省略")
+    parser.add_argument("-t", "--target-column", required=True, help="写入列，不存在时自动创建")
+    parser.add_argument("-o", "--output", help="输出文件路径(.xlsx、.csv、.parquet或.feather)")
+
+    template_group = parser.add_mutually_exclusive_group(required=True)
+    template_group.add_argument("--template", help="预设模板或已保存模板的名称")
+    template_group.add_argument("--template-file", help="从文本文件读取提示词模板")
+    template_group.add_argument("--prompt", help="直接指定提示词模板")
+    parser.add_argument("--templates-path", default="prompt_templates.json",
+                        help="用户模板文件路径(默认: prompt_templates.json)")
+    parser.add_argument("--no-clean", action="append", default=[],
+                        choices=[name for name, _ in CLEANING_STEPS], metavar="STEP",
+                        help="关闭指定的输出清理步骤，可多次指定: "
+                             + ", ".join(f"{name}({label})" for name, label in CLEANING_STEPS))
+
+    parser.add_argument("--api-type", choices=["openai", "ollama"],
+                        help="AI服务类型(默认读取config.ini)")
+    parser.add_argument("--model", required=True, help="模型名称")
+    parser.add_argument("--api-key", help="OpenAI API密钥(默认读取config.ini或OPENAI_API_KEY)")
+    parser.add_argument("--ollama-url",
+                        help="Ollama API地址(默认读取config.ini)；多个地址用逗号分隔时在各地址之间负载均衡")
+    parser.add_argument("--base-url",
+                        help="OpenAI兼容接口地址，如 http://host:8000/v1(默认读取config.ini的openai_base_url)；"
+                             "多个地址用逗号分隔时在各地址之间负载均衡，批处理模式只使用第一个")
+    parser.add_argument("--config", default="config.ini", help="配置文件路径(默认: config.ini)")
+    parser.add_argument("--ollama-option", dest="ollama_options", action="append", default=[],
+                        metavar="KEY=VALUE",
+                        help="传给Ollama的模型参数，可多次指定，如 num_ctx=8192、num_predict=64、"
+                             "num_thread=8、temperature=0.2，其他参数的值按JSON解析(如 top_k=40)；覆盖已保存模板中的设置")
+    parser.add_argument("--keep-alive",
+                        help="Ollama模型在最后一次请求后保持加载的时间，如 30m、3600，-1为一直保持(默认使用Ollama的设置)")
+    parser.add_argument("--no-warmup", action="store_true",
+                        help="不预热Ollama模型(默认在第一个请求前先加载模型，避免首批请求因加载超时)")
+
+    parser.add_argument("--threads", type=int, default=4, help="并发线程数，不设上限(默认: 4)")
+    parser.add_argument("--chunk-size", type=int, default=1,
+                        help="工作线程每次从队列领取的行数(默认: 1)")
+    parser.add_argument("--pack-size", type=int, default=1,
+                        help="每次模型调用合并的行数，模型以JSON数组返回各行结果，"
+                             "适合输出很短的模板；结果无法解析时自动改为逐行请求(默认: 1，不合并)")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread",
+                        help="执行方式: thread为多线程，async为asyncio异步引擎(默认: thread)")
+    parser.add_argument("--max-in-flight", type=int, default=100,
+                        help="异步引擎同时在途的最大请求数(默认: 100)")
+    parser.add_argument("--batch", action="store_true",
+                        help="使用OpenAI Batch API离线批处理：提交后轮询直到完成再导出，费用更低，"
+                             "通常24小时内完成；批处理信息保存在 输入文件.batch.json")
+    parser.add_argument("--batch-resume", action="store_true",
+                        help="继续轮询 输入文件.batch.json 中记录的批处理并合并结果(如上次轮询被中断)")
+    parser.add_argument("--batch-poll-interval", type=float, default=60,
+                        help="查询批处理状态的间隔秒数(默认: 60)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="根据延迟和429/503自动调整并发，--threads或--max-in-flight作为上限")
+    parser.add_argument("--rpm", type=int, default=0, help="每分钟请求数上限，0表示不限制(默认: 0)")
+    parser.add_argument("--tpm", type=int, default=0, help="每分钟令牌数上限，0表示不限制(默认: 0)")
+    parser.add_argument("--timeout-retries", type=int, default=2, help="超时重试次数(默认: 2)")
+    parser.add_argument("--server-error-retries", type=int, default=3,
+                        help="5xx和连接失败重试次数(默认: 3)")
+    parser.add_argument("--rate-limit-retries", type=int, default=5, help="429限流重试次数(默认: 5)")
+    parser.add_argument("--errors-file",
+                        help="重试后仍失败的行写入此CSV文件(默认: 输出文件名加 .errors.csv)")
+    parser.add_argument("--retry-errors",
+                        help="只重跑错误文件中列出的行；此时输入文件应为上次的输出文件")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                        help=f"响应缓存数据库路径(默认: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true", help="不读写响应缓存，总是重新请求模型")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="缓存最多保留的条目数，超出时淘汰最久未用的(默认: 100000)")
+    parser.add_argument("--cache-max-age-days", type=float, default=30,
+                        help="缓存条目的有效天数(默认: 30)")
+    parser.add_argument("--checkpoint",
+                        help="检查点文件路径(默认: 输入文件名加 .checkpoint.jsonl)")
+    parser.add_argument("--checkpoint-every", type=int, default=10,
+                        help="每生成多少行写入一次检查点，0表示不写检查点(默认: 10)")
+    parser.add_argument("--resume", action="store_true",
+                        help="从检查点继续：载入已完成的行并跳过它们；流式模式下跳过输出文件中已有的行")
+    parser.add_argument("--only-changed", action="store_true",
+                        help="增量模式：只处理写入列为空或引用内容/模板/模型与上次不同的行")
+    parser.add_argument("--export-prompts",
+                        help="把每行渲染后的提示词导出到此文件(.csv/.xlsx/.parquet/.feather)")
+    parser.add_argument("--prompts-only", action="store_true",
+                        help="只导出提示词，不调用模型(需配合 --export-prompts)")
+    parser.add_argument("--stream", action="store_true",
+                        help="流式处理大CSV文件：分块读取、生成并追加写入输出文件，内存占用与文件大小无关")
+    parser.add_argument("--stream-chunk-rows", type=int, default=1000,
+                        help="流式模式下每块的行数(默认: 1000)")
+    parser.add_argument("--encoding", help="输入CSV编码(默认自动检测)")
+    parser.add_argument("--output-encoding", default="utf-8-sig", help="输出CSV编码(默认: utf-8-sig)")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="进度输出间隔秒数(默认: 5)")
+    return parser
+
+
+def log(message):
+    """输出带时间戳的日志到标准错误"""
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+
+
+def log_load_progress(rows_read, total_rows):
+    """大Excel文件每读取10万行输出一次进度"""
+    if rows_read and rows_read % 100000 == 0:
+        log(f"正在读取Excel: {rows_read}/{total_rows or '?'} 行")
+
+
+def run_job(job, progress_interval, concurrency=None, cache=None):
+    """运行生成任务直到结束，返回 {行索引: 生成内容}"""
+    results = {}
+    processed = 0
+    total_rows = job.total_rows
+    meter = ProgressMeter(total_rows)
+    last_report = time.time()
+
+    job.start()
+    while True:
+        while not job.progress_queue.empty():
+            job.progress_queue.get()
+            processed += 1
+
+        while not job.result_queue.empty():
+            idx, content = job.result_queue.get()
+            if idx == "ERROR":
+                raise RuntimeError(content)
+            results[idx] = content
+
+        if not job.is_running() and job.result_queue.empty():
+            break
+
+        meter.update(processed)
+        now = time.time()
+        if now - last_report >= progress_interval:
+            message = f"已处理 {meter.status_text()}"
+            if job.status_message:
+                message += f"，{job.status_message}"
+            if job.total_requests < total_rows:
+                message += f"，去重后请求 {job.completed_requests}/{job.total_requests}"
+            if job.failures:
+                message += f"，失败 {len(job.failures)} 行"
+            if concurrency is not None:
+                message += f"，当前并发 {concurrency.limit}/{concurrency.max_limit}"
+            if cache is not None:
+                message += f"，{cache.stats_text()}"
+            log(message)
+            log_endpoint_stats(job.engine)
+            last_report = now
+        time.sleep(0.1)
+
+    elapsed = max(meter.elapsed(), 1e-6)
+    if job.total_requests < total_rows:
+        log(f"去重后实际请求 {job.total_requests} 次(共 {total_rows} 行)")
+    log(f"处理完成 {len(results)}/{total_rows} 行，失败 {len(job.failures)} 行，用时 {elapsed:.1f} 秒 ({len(results) / elapsed:.2f} 行/秒)")
+    if cache is not None:
+        log(cache.stats_text())
+    log_endpoint_stats(job.engine)
+    return results
+
+
+def log_endpoint_stats(engine):
+    """配置了多个接口时逐个输出各接口的吞吐和状态"""
+    if engine.endpoints is not None:
+        for line in engine.endpoints.stats_lines():
+            log(f"  {line}")
+
+
+def read_error_rows(errors_path):
+    """读取错误文件中的行号(从1开始)，返回行位置列表"""
+    with open(errors_path, 'r', encoding='utf-8-sig', newline='') as f:
+        return [int(record["行号"]) - 1 for record in csv.DictReader(f)]
+
+
+def write_errors_file(failures, errors_path):
+    """把失败行写入CSV文件，行号从1开始"""
+    with open(errors_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["行号", "状态", "尝试次数", "错误信息"])
+        for failure in sorted(failures, key=lambda item: item["row"]):
+            writer.writerow([failure["row"] + 1, failure["status"], failure["attempts"], failure["error"]])
+
+
+def build_engine(args, api_type, api_key, ollama_url, prompt_template, base_url=None, ollama_options=None):
+    """根据命令行参数创建生成引擎，返回(引擎, 自适应并发控制器, 响应缓存)"""
+    max_concurrency = args.max_in_flight if args.engine == "async" else args.threads
+    concurrency = AdaptiveConcurrency(max_concurrency) if args.adaptive else None
+    rate_limiter = RateLimiter(args.rpm, args.tpm) if args.rpm > 0 or args.tpm > 0 else None
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = ResponseCache(args.cache, args.cache_max_entries, args.cache_max_age_days)
+        except Exception as e:
+            log(f"无法打开响应缓存，本次不使用缓存: {str(e)}")
+    engine = GenerationEngine(
+        api_type=api_type,
+        model=args.model,
+        prompt_template=prompt_template,
+        api_key=api_key,
+        ollama_url=ollama_url,
+        pool_size=max_concurrency,
+        concurrency=concurrency,
+        rate_limiter=rate_limiter,
+        retry_policy=RetryPolicy(args.timeout_retries, args.server_error_retries, args.rate_limit_retries),
+        cache=cache,
+        cleaning_steps=resolve_cleaning_steps(args),
+        base_url=base_url,
+        ollama_options=ollama_options,
+        keep_alive=parse_keep_alive(args.keep_alive)
+    )
+    return engine, concurrency, cache
+
+
+def create_job(args, engine, df, rows=None, checkpoint=None, warm_up=True):
+    """根据执行方式创建多线程、异步或Batch API生成任务，warm_up为False时不预热Ollama模型"""
+    if args.batch:
+        return OpenAIBatchJob(engine, df, args.ref_columns, rows=rows, checkpoint=checkpoint,
+                              state_path=batch_state_path_for(args.input),
+                              requests_path=batch_requests_path_for(args.input),
+                              resume=args.batch_resume, poll_interval=args.batch_poll_interval)
+    warm_up = warm_up and engine.api_type == "ollama" and not args.no_warmup
+    if args.engine == "async":
+        return AsyncGenerationJob(engine, df, args.ref_columns, max_in_flight=args.max_in_flight,
+                                  rows=rows, checkpoint=checkpoint, pack_size=args.pack_size,
+                                  warm_up=warm_up)
+    return GenerationJob(engine, df, args.ref_columns, num_threads=args.threads,
+                         chunk_size=args.chunk_size, rows=rows, checkpoint=checkpoint,
+                         pack_size=args.pack_size, warm_up=warm_up)
+
+
+def export_prompts(job, args):
+    """导出任务中每行渲染后的提示词"""
+    write_table(job.prompts_dataframe(), args.export_prompts, args.output_encoding)
+    log(f"已导出 {job.total_rows} 行提示词(去重后 {job.total_requests} 条)到: {args.export_prompts}")
+
+
+def report_failures(args, failures):
+    """写出失败行并返回程序返回码"""
+    if not failures:
+        return 0
+    errors_path = args.errors_file or f"{args.output}.errors.csv"
+    write_errors_file(failures, errors_path)
+    log(f"{len(failures)} 行重试后仍失败，已写入: {errors_path}")
+    log(f"可使用 --retry-errors {errors_path} 并以 {args.output} 作为输入只重跑这些行")
+    return 3
+
+
+def run_streaming(args, engine, concurrency, cache):
+    """分块读取CSV，逐块生成并追加写入输出文件，返回失败行列表
+
+    内存占用只与分块大小有关。输出文件只包含已完整处理的分块，
+    因此 --resume 时跳过输出文件中已有的行数即可继续。
+    """
+    skip_rows = 0
+    if args.resume and os.path.exists(args.output):
+        skip_rows = count_csv_rows(args.output, args.output_encoding)
+        log(f"输出文件中已有 {skip_rows} 行，从第 {skip_rows + 1} 行继续")
+
+    encoding, chunks = iter_csv_chunks(args.input, args.stream_chunk_rows, args.encoding, skip_rows)
+    log(f"已使用 {encoding} 编码分块读取文件，每块 {args.stream_chunk_rows} 行")
+
+    failures = []
+    written_rows = skip_rows
+    header = skip_rows == 0
+    for chunk in chunks:
+        missing = [col for col in args.ref_columns if col not in chunk.columns]
+        if missing:
+            raise ValueError(f"引用列不存在: {', '.join(missing)}")
+        ensure_text_column(chunk, args.target_column)
+
+        # 模型只需在第一块之前预热一次
+        job = create_job(args, engine, chunk, warm_up=written_rows == skip_rows)
+        results = run_job(job, args.progress_interval, concurrency, cache)
+        for idx, content in results.items():
+            chunk.at[idx, args.target_column] = content
+
+        append_csv(chunk, args.output, args.output_encoding, header)
+        header = False
+        # 失败行的行号换算为整个文件中的位置
+        failures.extend(dict(failure, row=failure["row"] + written_rows) for failure in job.failures)
+        written_rows += len(chunk)
+        log(f"已写入 {written_rows} 行到 {args.output}")
+    return failures
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.output and not args.prompts_only:
+        parser.error("必须指定 -o/--output")
+
+    api_key, ollama_url, api_type = load_api_config(args.config)
+    api_type = args.api_type or api_type
+    api_key = args.api_key or api_key
+    ollama_url = args.ollama_url or ollama_url
+    base_url = args.base_url or load_openai_base_url(args.config)
+
+    if api_type == "openai" and not api_key:
+        log("错误: 请通过 --api-key、config.ini 或 OPENAI_API_KEY 提供OpenAI API密钥")
+        return 1
+
+    if args.stream:
+        if args.only_changed or args.retry_errors or args.export_prompts or args.prompts_only:
+            log("错误: 流式模式不支持 --only-changed、--retry-errors、--export-prompts 和 --prompts-only")
+            return 1
+        if not (args.input.lower().endswith('.csv') and args.output.lower().endswith('.csv')):
+            log("错误: 流式模式的输入和输出文件都必须是CSV")
+            return 1
+    batch_state_path = batch_state_path_for(args.input)
+    if args.batch_resume:
+        args.batch = True
+        if args.resume or args.only_changed or args.retry_errors:
+            log("错误: --batch-resume 使用提交批处理时的行，不能与 --resume、--only-changed、--retry-errors 同时使用")
+            return 1
+    if args.batch:
+        if api_type != "openai" or args.stream:
+            log("错误: 批处理模式只支持OpenAI接口，且不能与 --stream 同时使用")
+            return 1
+        if not args.batch_resume and os.path.exists(batch_state_path):
+            log(f"错误: 已有提交过的批处理 ({batch_state_path})，请使用 --batch-resume 继续，"
+                f"或删除该文件后重新提交")
+            return 1
+    if args.prompts_only and not args.export_prompts:
+        log("错误: --prompts-only 需要配合 --export-prompts 使用")
+        return 1
+
+    try:
+        prompt_template = resolve_prompt_template(args)
+        ollama_options = resolve_ollama_options(args)
+    except Exception as e:
+        log(f"错误: {str(e)}")
+        return 1
+
+    if args.stream:
+        engine, concurrency, cache = build_engine(args, api_type, api_key, ollama_url, prompt_template,
+                                                  base_url, ollama_options)
+        try:
+            failures = run_streaming(args, engine, concurrency, cache)
+        except KeyboardInterrupt:
+            log(f"已中断，已完成的分块保存在 {args.output}，可使用 --resume 继续")
+            return 130
+        except Exception as e:
+            log(f"处理数据时出错: {str(e)}")
+            return 1
+        finally:
+            engine.close()
+            if cache is not None:
+                cache.close()
+        log(f"文件已成功导出到: {args.output}")
+        return report_failures(args, failures)
+
+    try:
+        df, encoding = read_table(args.input, args.encoding, progress=log_load_progress)
+    except Exception as e:
+        log(f"错误: {str(e)}")
+        return 1
+
+    if encoding:
+        log(f"已使用 {encoding} 编码加载文件")
+    log(f"已加载文件: {os.path.basename(args.input)}，共 {len(df)} 行数据")
+
+    missing = [col for col in args.ref_columns if col not in df.columns]
+    if missing:
+        log(f"错误: 引用列不存在: {', '.join(missing)}")
+        return 1
+    placeholder_columns = template_columns(prompt_template, df.columns)
+    if not args.ref_columns and not placeholder_columns:
+        log("错误: 请用 -r 指定引用列，或在模板中使用 {列名} 占位符")
+        return 1
+
+    rows = None
+    if args.retry_errors:
+        try:
+            rows = read_error_rows(args.retry_errors)
+        except Exception as e:
+            log(f"读取错误文件时出错: {str(e)}")
+            return 1
+        log(f"只重跑错误文件中的 {len(rows)} 行")
+
+    # 如果是新列但不在DataFrame中，则创建它；已有的空列转为object类型以便写入文本
+    ensure_text_column(df, args.target_column)
+
+    # 行指纹从输入文件旁读取，运行后保存到输出文件旁，下次以输出文件为输入即可增量运行
+    fingerprint_columns = args.ref_columns + [col for col in placeholder_columns if col not in args.ref_columns]
+    fingerprints = compute_fingerprints(df, fingerprint_columns, prompt_template, args.model)
+    try:
+        previous_fingerprints = load_fingerprints(fingerprint_path_for(args.input), args.target_column)
+    except Exception as e:
+        log(f"读取行指纹时出错，视为全部已变化: {str(e)}")
+        previous_fingerprints = []
+
+    checkpoint_path = args.checkpoint or checkpoint_path_for(args.input)
+    signature = checkpoint_signature(prompt_template, args.model, args.ref_columns)
+    completed = {}
+    if args.resume:
+        try:
+            completed = load_checkpoint(checkpoint_path, args.target_column, signature)
+        except Exception as e:
+            log(f"读取检查点时出错: {str(e)}")
+            return 1
+        rows = apply_checkpoint(df, args.target_column, completed, rows)
+        log(f"从检查点载入 {len(completed)} 行，剩余 {len(rows)} 行待处理")
+
+    if args.only_changed:
+        rows = select_changed_rows(df, args.target_column, fingerprints, previous_fingerprints, rows)
+        log(f"增量模式：{len(rows)} 行为空或已变化，需要处理")
+
+    if args.batch_resume:
+        try:
+            batch_state = load_batch_state(batch_state_path)
+            batch_ids = [item["batch_id"] for item in state_batches(batch_state)]
+        except Exception as e:
+            log(f"读取批处理状态文件时出错: {str(e)}")
+            return 1
+        rows = batch_state["rows"]
+        log(f"继续获取批处理 {', '.join(batch_ids)} 的结果(提交于 {batch_state.get('created', '')}，共 {len(rows)} 行)")
+
+    engine, concurrency, cache = build_engine(args, api_type, api_key, ollama_url, prompt_template, base_url,
+                                              ollama_options)
+    if args.prompts_only:
+        try:
+            export_prompts(create_job(args, engine, df, rows), args)
+        except Exception as e:
+            log(f"导出提示词时出错: {str(e)}")
+            return 1
+        finally:
+            engine.close()
+            if cache is not None:
+                cache.close()
+        return 0
+
+    checkpoint = None
+    if args.checkpoint_every > 0:
+        checkpoint = CheckpointWriter(checkpoint_path, args.target_column, args.checkpoint_every,
+                                      append=args.resume and bool(completed), signature=signature)
+    job = create_job(args, engine, df, rows, checkpoint)
+    if args.export_prompts:
+        try:
+            export_prompts(job, args)
+        except Exception as e:
+            log(f"导出提示词时出错: {str(e)}")
+
+    try:
+        results = run_job(job, args.progress_interval, concurrency, cache)
+        # 将结果应用到数据框
+        for idx, content in results.items():
+            df.at[idx, args.target_column] = content
+    except KeyboardInterrupt:
+        if args.batch and os.path.exists(batch_state_path):
+            log("已中断，批处理仍在服务端运行，可使用 --batch-resume 继续获取结果")
+        elif checkpoint is not None:
+            log(f"已中断，已完成的行保存在 {checkpoint_path}，可使用 --resume 继续")
+        else:
+            log("已中断")
+        return 130
+    except Exception as e:
+        log(f"处理数据时出错: {str(e)}")
+        return 1
+    finally:
+        engine.close()
+        if cache is not None:
+            cache.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+    try:
+        write_table(df, args.output, args.output_encoding)
+    except Exception as e:
+        log(f"导出文件时出错: {str(e)}")
+        return 1
+
+    log(f"文件已成功导出到: {args.output}")
+    try:
+        save_fingerprints(fingerprint_path_for(args.output), args.target_column,
+                          update_fingerprints(previous_fingerprints, fingerprints,
+                                              job.completed_rows + list(completed)))
+    except Exception as e:
+        log(f"保存行指纹时出错: {str(e)}")
+    if checkpoint is not None:
+        # 结果已完整写入输出文件，检查点不再需要
+        os.remove(checkpoint_path)
+    if args.batch:
+        # 批处理结果已合并，状态文件和请求文件不再需要
+        for path in (batch_state_path, batch_requests_path_for(args.input)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return report_failures(args, job.failures)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
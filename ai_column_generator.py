@@ -3,16 +3,36 @@ import sys
 import pandas as pd
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from openai import OpenAI
 import configparser
 import json
 from typing import List, Dict, Any, Optional
 import time
 import requests  # 用于Ollama API请求
-import threading  # 用于多线程处理
-import queue  # 用于线程间通信
+import threading  # 用于后台流式预览
+import queue  # 用于从工作线程接收结果
 import re
-# chardet会在需要时动态导入
+from ai_engine import (
+    DEFAULT_OLLAMA_URL, PRESET_TEMPLATES, GenerationEngine, GenerationJob,
+    AsyncGenerationJob, AdaptiveConcurrency, RateLimiter, RetryPolicy,
+    load_api_config, load_openai_base_url, load_user_templates, get_template_content,
+    replace_template_variables, build_reference_contents, template_columns,
+    CLEANING_STEPS, default_cleaning_steps, get_template_cleaning, ProgressMeter,
+    get_template_options, parse_ollama_options, parse_keep_alive, parse_endpoints
+)
+from table_io import detect_csv_encoding, write_table, ProjectedTable, COLUMNAR_EXTENSIONS, ensure_text_column
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+from checkpoint import (
+    CheckpointWriter, checkpoint_path_for, checkpoint_signature, load_checkpoint, apply_checkpoint
+)
+from fingerprints import (
+    fingerprint_path_for, compute_fingerprints, load_fingerprints, save_fingerprints,
+    select_changed_rows, update_fingerprints
+)
+
+UI_MAX_ITEMS_PER_TICK = 5000  # 进度窗口每次刷新最多处理的进度信号/结果数量
+PREVIEW_REFRESH_MS = 50  # 流式预览的刷新间隔(毫秒)
+OLLAMA_OPTION_FIELDS = [("num_ctx", "上下文长度"), ("num_predict", "最大输出长度"),
+                        ("num_thread", "CPU线程数"), ("temperature", "温度")]
 
 class TemplatePreviewDialog:
     """模板预览对话框，用于预览模板效果和测试变量替换"""
@@ -153,28 +173,25 @@ class AIColumnGenerator:
         self.root.geometry("900x750")  # 增加窗口高度
         
         self.file_path = None
-        self.df = None
+        self.table = None  # 按列投影加载的表格(ProjectedTable)
+        self.df = None  # 已加载的列，即 self.table.df
         self.api_key = None
-        self.ollama_url = "http://localhost:11434"  # Ollama默认API地址
+        self.ollama_url = DEFAULT_OLLAMA_URL  # Ollama默认API地址
         self.api_type = "openai"  # 默认使用OpenAI API
+        self.openai_base_url = None  # OpenAI兼容接口地址(config.ini的openai_base_url)
+        self.preview_running = False  # 是否有流式预览正在进行
+        
+        # 上一次批量生成中重试后仍失败的行，可以只重跑这些行
+        self.last_failures = []
+        self.last_failures_target = None
+        
+        # 各写入列的行指纹 {写入列: 指纹列表}，导出时保存到导出文件旁，供增量模式使用
+        self.row_fingerprints = {}
+        self.row_fingerprints_file = None
         
         # 提示词模板管理
         self.templates = {}  # 用户保存的模板
-        self.preset_templates = {
-            "摘要生成": "请根据以下内容生成一段简洁的摘要：\n\n{引用内容}",
-            "内容翻译": "请将以下内容翻译成英文：\n\n{引用内容}",
-            "情感分析": "请分析以下内容的情感倾向(积极、消极或中性)，并给出理由：\n\n{引用内容}",
-            "关键词提取": "请从以下内容中提取5个最重要的关键词或短语：\n\n{引用内容}",
-            "内容分类": "请将以下内容分类到最合适的类别(例如：科技、健康、教育、娱乐等)，并说明理由：\n\n{引用内容}",
-            "观点提取": "请从以下内容中提取主要观点和论点：\n\n{引用内容}",
-            "问题回答": "请根据以下内容回答问题：\n{如果:问题:问题: {问题}\n\n}参考内容:\n{引用内容}",
-            "数据提取": "请从以下文本中提取所有数字数据，并按类别整理：\n\n{引用内容}",
-            "简介生成": "请根据以下内容生成一段专业的产品/服务简介，突出其主要特点和价值：\n\n{引用内容}",
-            "医学报告分析": "请分析以下医学报告内容，提取关键指标并解释其含义：\n\n{引用内容}",
-            "技术文档简化": "请将以下技术文档内容转换为普通用户容易理解的语言：\n\n{引用内容}",
-            "学术摘要": "请将以下学术内容生成一段摘要，包含研究目的、方法、结果和结论：\n\n{引用内容}",
-            "血压数据提取": "请从以下医疗记录中提取患者的血压数据，只返回血压值，格式为'血压X/YmmHg'：\n\n{引用内容}"
-        }
+        self.preset_templates = dict(PRESET_TEMPLATES)
         
         self.load_config()
         self.load_templates()
@@ -197,21 +214,8 @@ class AIColumnGenerator:
     
     def load_config(self):
         """加载配置文件，获取API密钥和Ollama设置"""
-        config = configparser.ConfigParser()
-        
-        if os.path.exists('config.ini'):
-            config.read('config.ini')
-            if 'API' in config:
-                if 'openai_api_key' in config['API']:
-                    self.api_key = config['API']['openai_api_key']
-                if 'ollama_url' in config['API']:
-                    self.ollama_url = config['API']['ollama_url']
-                if 'api_type' in config['API']:
-                    self.api_type = config['API']['api_type']
-        
-        if not self.api_key and self.api_type == 'openai':
-            # 如果没有找到API密钥，则从环境变量中获取
-            self.api_key = os.environ.get('OPENAI_API_KEY')
+        self.api_key, self.ollama_url, self.api_type = load_api_config()
+        self.openai_base_url = load_openai_base_url()  # 只能在config.ini中设置
     
     def save_config(self):
         """保存配置到文件"""
@@ -221,18 +225,15 @@ class AIColumnGenerator:
             'ollama_url': self.ollama_url,
             'api_type': self.api_type
         }
+        if self.openai_base_url:
+            config['API']['openai_base_url'] = self.openai_base_url
         
         with open('config.ini', 'w') as f:
             config.write(f)
     
     def load_templates(self):
         """加载用户保存的提示词模板"""
-        if os.path.exists('prompt_templates.json'):
-            try:
-                with open('prompt_templates.json', 'r', encoding='utf-8') as f:
-                    self.templates = json.load(f)
-            except:
-                self.templates = {}
+        self.templates = load_user_templates()
     
     def save_templates(self):
         """保存提示词模板到文件"""
@@ -342,7 +343,7 @@ class AIColumnGenerator:
         self.toggle_api_btn.grid(row=1, column=3, padx=5, pady=5)
         
         # Ollama URL
-        self.ollama_url_label = ttk.Label(api_frame, text="Ollama URL:")
+        self.ollama_url_label = ttk.Label(api_frame, text="Ollama URL(多个用逗号分隔):")
         self.ollama_url_label.grid(row=2, column=0, sticky=tk.W, padx=5, pady=5)
         self.ollama_url_var = tk.StringVar(value=self.ollama_url)
         self.ollama_url_entry = ttk.Entry(api_frame, textvariable=self.ollama_url_var, width=50)
@@ -433,14 +434,42 @@ class AIColumnGenerator:
         self.prompt_text.pack(fill=tk.X, padx=5, pady=5)
         self.prompt_text.insert(tk.END, "请根据以下内容生成一段总结:\n{引用内容}")
         
+        # 输出清理步骤开关，随模板一起保存
+        cleaning_frame = ttk.Frame(prompt_frame)
+        cleaning_frame.pack(fill=tk.X, padx=5)
+        ttk.Label(cleaning_frame, text="输出清理:").pack(side=tk.LEFT)
+        self.cleaning_vars = {}
+        for name, label in CLEANING_STEPS:
+            self.cleaning_vars[name] = tk.BooleanVar(value=True)
+            ttk.Checkbutton(cleaning_frame, text=label,
+                            variable=self.cleaning_vars[name]).pack(side=tk.LEFT, padx=5)
+        
+        # Ollama模型参数，随模板一起保存，留空使用模型默认值
+        options_frame = ttk.Frame(prompt_frame)
+        options_frame.pack(fill=tk.X, padx=5, pady=(5, 0))
+        ttk.Label(options_frame, text="Ollama参数:").pack(side=tk.LEFT)
+        self.ollama_option_vars = {}
+        for name, label in OLLAMA_OPTION_FIELDS:
+            ttk.Label(options_frame, text=label).pack(side=tk.LEFT, padx=(5, 0))
+            self.ollama_option_vars[name] = tk.StringVar()
+            ttk.Entry(options_frame, textvariable=self.ollama_option_vars[name],
+                      width=7).pack(side=tk.LEFT, padx=2)
+        
         # 处理按钮
         button_frame = ttk.Frame(main_frame)
         button_frame.pack(fill=tk.X, pady=10)
         
         ttk.Button(button_frame, text="预览", command=self.preview_generation).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="生成并更新", command=self.generate_and_update).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="导出提示词", command=self.export_prompts).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="导出文件", command=self.export_file).pack(side=tk.LEFT, padx=5)
         
+        # 响应缓存：相同的模型和提示词直接复用上次结果，取消勾选则总是重新请求
+        self.use_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(button_frame, text="使用响应缓存", 
+                        variable=self.use_cache_var).pack(side=tk.LEFT, padx=15)
+        ttk.Button(button_frame, text="清空缓存", command=self.clear_response_cache).pack(side=tk.LEFT, padx=5)
+        
         # 预览区域
         preview_frame = ttk.LabelFrame(main_frame, text="预览", padding=10)
         preview_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -468,7 +497,8 @@ class AIColumnGenerator:
         """选择Excel或CSV文件"""
         file_path = filedialog.askopenfilename(
             title="选择Excel或CSV文件",
-            filetypes=[("Excel文件", "*.xlsx *.xls"), ("CSV文件", "*.csv"), ("所有文件", "*.*")]
+            filetypes=[("Excel文件", "*.xlsx *.xls"), ("CSV文件", "*.csv"),
+                       ("Parquet/Feather文件", "*.parquet *.feather *.arrow"), ("所有文件", "*.*")]
         )
         
         if not file_path:
@@ -481,77 +511,25 @@ class AIColumnGenerator:
             # 根据文件类型读取数据
             if file_path.endswith('.csv'):
                 try:
-                    # 先尝试使用二进制模式读取文件头部，检测BOM标记
-                    with open(file_path, 'rb') as f:
-                        raw_data = f.read(4)
-                        
-                    # 检查是否有UTF-8 BOM标记 (EF BB BF)
-                    if raw_data.startswith(b'\xef\xbb\xbf'):
-                        encoding = 'utf-8-sig'
-                    else:
-                        # 尝试通过内容检测编码
-                        try:
-                            import chardet
-                            with open(file_path, 'rb') as f:
-                                raw_data = f.read(10000)  # 读取前10KB数据用于检测
-                            result = chardet.detect(raw_data)
-                            encoding = result['encoding']
-                            confidence = result['confidence']
-                            self.status_var.set(f"检测到编码: {encoding} (置信度: {confidence:.2f})")
-                        except ImportError:
-                            # 如果没有安装chardet，则尝试常见编码
-                            encodings_to_try = ['utf-8', 'gbk', 'cp936', 'latin1']
-                            encoding = None
-                            for enc in encodings_to_try:
-                                try:
-                                    # 尝试读取文件前几行
-                                    with open(file_path, 'r', encoding=enc) as f:
-                                        for _ in range(5):
-                                            f.readline()
-                                    encoding = enc
-                                    break
-                                except UnicodeDecodeError:
-                                    continue
-                            
-                            # 如果没有找到合适的编码，默认使用utf-8
-                            if not encoding:
-                                encoding = 'utf-8'
+                    encoding, confidence = detect_csv_encoding(file_path)
+                    if confidence is not None:
+                        self.status_var.set(f"检测到编码: {encoding} (置信度: {confidence:.2f})")
                     
-                    # 使用检测到的编码打开CSV文件
+                    # 使用检测到的编码打开CSV文件，失败时自动尝试其他常见编码
+                    # 只读取表头和第一列，生成时再按需加载用到的列
                     try:
-                        self.df = pd.read_csv(file_path, encoding=encoding)
-                        self.status_var.set(f"已使用 {encoding} 编码加载文件")
-                    except Exception as e:
-                        # 如果还是失败，尝试其他编码
-                        success = False
-                        encodings_to_try = ['utf-8', 'utf-8-sig', 'gbk', 'gb2312', 'cp936', 'latin1']
-                        
-                        # 确保不重复尝试已失败的编码
-                        if encoding in encodings_to_try:
-                            encodings_to_try.remove(encoding)
-                        
-                        for enc in encodings_to_try:
-                            try:
-                                self.df = pd.read_csv(file_path, encoding=enc)
-                                self.status_var.set(f"已使用 {enc} 编码加载文件")
-                                success = True
-                                break
-                            except UnicodeDecodeError:
-                                continue
-                            except Exception as specific_error:
-                                # 记录特定编码的错误，但继续尝试其他编码
-                                print(f"使用 {enc} 编码读取时出错: {str(specific_error)}")
-                        
-                        if not success:
-                            messagebox.showerror("错误", f"无法自动检测文件编码，请使用\"手动指定编码打开\"功能。原始错误: {str(e)}")
-                            self.status_var.set("读取文件失败")
-                            return
+                        self.open_table(file_path, encoding)
+                        self.status_var.set(f"已使用 {self.table.encoding} 编码加载文件")
+                    except ValueError as e:
+                        messagebox.showerror("错误", f"{str(e)}\n请使用\"手动指定编码打开\"功能。")
+                        self.status_var.set("读取文件失败")
+                        return
                 except Exception as e:
                     messagebox.showerror("错误", f"读取CSV文件时出错: {str(e)}")
                     self.status_var.set("读取文件失败")
                     return
             else:
-                self.df = pd.read_excel(file_path)
+                self.open_table(file_path)
             
             # 更新列选择下拉框
             self.update_column_selections()
@@ -562,10 +540,51 @@ class AIColumnGenerator:
             messagebox.showerror("错误", f"读取文件时出错: {str(e)}")
             self.status_var.set("读取文件失败")
     
+    def open_table(self, file_path, encoding=None):
+        """按列投影打开表格：先读取表头，数据列在用到时才加载(.xlsx一次读入，见 ProjectedTable)"""
+        file_name = os.path.basename(file_path)
+        
+        def show_load_progress(rows_read, total_rows):
+            """在状态栏显示Excel读取进度"""
+            if total_rows:
+                self.status_var.set(f"正在读取 {file_name}: {rows_read}/{total_rows} 行")
+            else:
+                self.status_var.set(f"正在读取 {file_name}: 已读取 {rows_read} 行")
+            self.root.update_idletasks()
+        
+        # 上次失败的行号只对原来的表格有效，换表后不再提供重试
+        self.last_failures = []
+        self.last_failures_target = None
+        self.table = ProjectedTable(file_path, encoding, progress=show_load_progress)
+        self.df = self.table.df
+    
+    def get_all_columns(self):
+        """源文件的全部列加上新建的列(包括尚未加载的列)"""
+        if self.table is not None:
+            return self.table.all_columns()
+        return self.df.columns.tolist()
+    
+    def get_template_columns(self, prompt_template=None):
+        """提示语中以 {列名} 占位符直接引用的数据列"""
+        if prompt_template is None:
+            prompt_template = self.prompt_text.get("1.0", tk.END).strip()
+        return template_columns(prompt_template, self.get_all_columns())
+    
+    def load_table_columns(self, columns):
+        """加载生成任务用到的列，源文件中不存在的列(新建列)忽略"""
+        if self.table is not None:
+            self.table.load_columns(columns)
+    
+    def get_export_dataframe(self):
+        """导出用的完整数据：读取完整文件并合并已加载和新建的列"""
+        if self.table is not None:
+            return self.table.merged()
+        return self.df
+    
     def update_column_selections(self):
         """更新列选择下拉框和列表框"""
         if self.df is not None:
-            columns = self.df.columns.tolist()
+            columns = self.get_all_columns()
             
             # 更新目标列下拉框，添加"新建列"选项
             self.target_column_combo['values'] = ["新建列"] + columns
@@ -624,8 +643,8 @@ class AIColumnGenerator:
         target_column = self.target_column_var.get()
         ref_columns = self.get_selected_ref_columns()
         
-        if not ref_columns:
-            messagebox.showwarning("警告", "请选择至少一个引用列")
+        if not ref_columns and not self.get_template_columns():
+            messagebox.showwarning("警告", "请选择至少一个引用列，或在提示语中使用{列名}占位符")
             return
         
         # 检查API配置
@@ -638,170 +657,163 @@ class AIColumnGenerator:
         
         # 获取提示语模板
         prompt_template = self.prompt_text.get("1.0", tk.END).strip()
+        try:
+            self.get_ollama_options()
+        except ValueError as e:
+            messagebox.showerror("错误", str(e))
+            return
         
         # 预览第一行数据
         try:
+            placeholder_columns = self.get_template_columns(prompt_template)
+            self.load_table_columns(ref_columns + placeholder_columns)
             row = self.df.iloc[0]
             ref_content = "\n".join([f"{col}: {row[col]}" for col in ref_columns])
-            prompt = prompt_template.replace("{引用内容}", ref_content)
-            
-            # 调用API生成内容
-            generated_content = self.generate_content_with_ai(ref_content)
-            
-            # 显示预览
-            self.preview_text.delete("1.0", tk.END)
-            self.preview_text.insert(tk.END, f"引用内容:\n{ref_content}\n\n")
-            self.preview_text.insert(tk.END, f"生成内容:\n{generated_content}")
-            
-            self.status_var.set("预览生成完成")
+            row_values = {col: row[col] for col in placeholder_columns}
         except Exception as e:
             messagebox.showerror("错误", f"生成预览时出错: {str(e)}")
             self.status_var.set("预览生成失败")
-    
-    def generate_content_with_ai(self, reference_text):
-        """使用AI生成内容"""
-        if self.api_type == "openai":
-            client = OpenAI(api_key=self.api_key)
-            prompt = self.prompt_text.get("1.0", tk.END).strip()
-            
-            # 替换模板中的变量
-            prompt = self.replace_template_variables(prompt, {"引用内容": reference_text})
-            
-            # 检查是否为医疗数据提取，特别是血压数据
-            system_message = "你是一个专业的内容生成助手，仅输出最终结果，不要包含思考过程。"
-            if '血压' in prompt.lower() or '收缩压' in prompt.lower() or '舒张压' in prompt.lower():
-                system_message = "你是一个医疗数据提取专家。只提取最终的数据结果，不要包含任何解释、思考过程或额外文字。对于血压数据，只返回格式为'血压X/YmmHg'的结果。"
-            
+            return
+        
+        if self.preview_running:
+            self.status_var.set("预览正在生成，请稍候")
+            return
+        self.preview_running = True
+        
+        # 在后台线程中流式调用API，生成的文本经队列交给主线程显示，界面不会被阻塞
+        cache = self.open_response_cache()
+        engine = self.create_generation_engine(cache=cache)
+        events = queue.Queue()
+        
+        def worker():
             try:
-                response = client.chat.completions.create(
-                    model=self.model_var.get(),
-                    messages=[
-                        {"role": "system", "content": system_message},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                )
-                return self.clean_ai_output(response.choices[0].message.content)
+                events.put(("done", engine.stream(ref_content, row_values,
+                                                  on_text=lambda text: events.put(("text", text)))))
             except Exception as e:
-                return f"生成错误: {str(e)}"
-        elif self.api_type == "ollama":
-            url = f"{self.ollama_url.rstrip('/')}/api/chat"
-            model = self.model_var.get()
-            prompt = self.prompt_text.get("1.0", tk.END).strip()
-            
-            # 替换模板中的变量
-            prompt = self.replace_template_variables(prompt, {"引用内容": reference_text})
-            
-            # 检查是否为deepseek模型
-            is_deepseek = "deepseek" in model.lower()
-            
-            # 检查是否为医疗数据提取，特别是血压数据
-            system_message = "你是一个专业的内容生成助手，仅输出最终结果，不要包含思考过程。"
-            if '血压' in prompt.lower() or '收缩压' in prompt.lower() or '舒张压' in prompt.lower():
-                system_message = "你是一个医疗数据提取专家。只提取最终的数据结果，不要包含任何解释、思考过程或额外文字。对于血压数据，只返回格式为'血压X/YmmHg'的结果。"
-            
-            # 尝试使用chat API
-            try:
-                if is_deepseek:
-                    # Deepseek模型特殊处理
-                    data = {
-                        "model": model,
-                        "messages": [
-                            {"role": "system", "content": system_message},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "stream": False
-                    }
-                else:
-                    # 常规Ollama模型
-                    data = {
-                        "model": model,
-                        "messages": [
-                            {"role": "system", "content": system_message},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "stream": False
-                    }
-                
-                response = requests.post(url, json=data, timeout=120)
-                if response.status_code == 200:
-                    result = response.json()
-                    if 'message' in result:
-                        return self.clean_ai_output(result['message']['content'])
-                    else:
-                        return self.clean_ai_output(result['response'])
+                events.put(("error", e))
+            finally:
+                engine.close()
+                if cache is not None:
+                    cache.close()
+        
+        self.preview_text.delete("1.0", tk.END)
+        self.preview_text.insert(tk.END, f"引用内容:\n{ref_content}\n\n生成内容:\n")
+        self.preview_text.mark_set("stream_start", "end-1c")
+        self.preview_text.mark_gravity("stream_start", tk.LEFT)
+        self.status_var.set("正在生成预览...")
+        
+        def pump():
+            texts = []
+            finished = None
+            while finished is None:
+                try:
+                    kind, value = events.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "text":
+                    texts.append(value)
                 else:
-                    # 如果chat API失败，尝试使用generate API
-                    url = f"{self.ollama_url.rstrip('/')}/api/generate"
-                    data = {
-                        "model": model,
-                        "prompt": f"{system_message}\n\n{prompt}",
-                        "stream": False
-                    }
-                    response = requests.post(url, json=data, timeout=120)
-                    if response.status_code == 200:
-                        result = response.json()
-                        return self.clean_ai_output(result['response'])
-                    else:
-                        return f"生成错误: API返回状态码 {response.status_code}"
-            except Exception as e:
-                return f"生成错误: {str(e)}"
-        else:
-            return "错误: 未知的API类型"
-
-    def clean_ai_output(self, text):
-        """清理AI输出，去除思考过程等多余内容"""
-        # 移除常见的思考过程标记
-        patterns = [
-            r"^(好的|嗯|我来|让我|首先|思考|理解中|分析中|处理中).*?\n",
-            r"^(这是|以下是|根据|分析|结果如下).*?\n",
-            r"\n*(根据提供的|参考文献|引用来源|注意事项|补充说明).*$",
-        ]
-        
-        result = text
-        for pattern in patterns:
-            result = re.sub(pattern, "", result, flags=re.MULTILINE)
+                    finished = (kind, value)
+            # 同一刷新周期内收到的文本合并后一次插入
+            if texts:
+                self.preview_text.insert(tk.END, "".join(texts))
+                self.preview_text.see(tk.END)
+            if finished is None:
+                self.root.after(PREVIEW_REFRESH_MS, pump)
+                return
             
-        # 去除多余的空行
-        result = re.sub(r'\n{3,}', '\n\n', result)
-        
-        # 特殊处理血压数据提取
-        # 检查是否是血压数据提取任务，如果是且找到血压格式，则只返回血压数据
-        blood_pressure_pattern = r'(\d{2,3}/\d{2,3})(?:\s*(?:mmHg|毫米汞柱))'
-        blood_pressure_match = re.search(blood_pressure_pattern, result)
-        
-        if blood_pressure_match:
-            prompt = self.prompt_text.get("1.0", tk.END).strip().lower()
-            if '血压' in prompt or '收缩压' in prompt or '舒张压' in prompt:
-                # 如果是血压提取任务，则只返回血压数据
-                bp_value = blood_pressure_match.group(1)
-                return f"血压{bp_value}mmHg"
-        
-        return result.strip()
+            self.preview_running = False
+            kind, value = finished
+            if kind == "error":
+                messagebox.showerror("错误", f"生成预览时出错: {str(value)}")
+                self.status_var.set("预览生成失败")
+                return
+            # 流式显示的是原始输出，完成后替换为清理后的内容
+            content, stats = value
+            self.preview_text.delete("stream_start", tk.END)
+            self.preview_text.insert(tk.END, content)
+            self.status_var.set(f"预览生成完成: {self.format_stream_stats(stats)}")
+        
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(PREVIEW_REFRESH_MS, pump)
+    
+    def format_stream_stats(self, stats):
+        """流式生成统计的显示文本"""
+        if stats["cached"]:
+            return f"命中响应缓存，用时 {stats['elapsed']:.2f} 秒"
+        parts = []
+        if stats["ttft"] is not None:
+            parts.append(f"首个令牌 {stats['ttft']:.2f} 秒")
+        if stats["tokens_per_sec"] is not None:
+            parts.append(f"{stats['tokens_per_sec']:.1f} 令牌/秒")
+        parts.append(f"共 {stats['tokens']} 令牌，用时 {stats['elapsed']:.2f} 秒")
+        return "，".join(parts)
+    
+    def open_response_cache(self):
+        """勾选了使用缓存时打开响应缓存，否则返回None"""
+        if not self.use_cache_var.get():
+            return None
+        try:
+            return ResponseCache(DEFAULT_CACHE_PATH)
+        except Exception as e:
+            self.status_var.set(f"无法打开响应缓存，本次不使用缓存: {str(e)}")
+            return None
+    
+    def clear_response_cache(self):
+        """清空本地响应缓存"""
+        if not messagebox.askyesno("确认", "确定要清空本地响应缓存吗？"):
+            return
+        try:
+            cache = ResponseCache(DEFAULT_CACHE_PATH)
+            cache.clear()
+            cache.close()
+            self.status_var.set("响应缓存已清空")
+        except Exception as e:
+            messagebox.showerror("错误", f"清空缓存时出错: {str(e)}")
+    
+    def get_cleaning_steps(self):
+        """读取界面上的输出清理步骤开关（必须在主线程调用）"""
+        return {name: var.get() for name, var in self.cleaning_vars.items()}
+    
+    def set_cleaning_steps(self, steps):
+        """把清理步骤开关设置到界面上"""
+        for name, var in self.cleaning_vars.items():
+            var.set(steps.get(name, True))
+    
+    def get_ollama_options(self):
+        """读取界面上的Ollama参数（必须在主线程调用），数值无效时抛出ValueError"""
+        return parse_ollama_options({name: var.get() for name, var in self.ollama_option_vars.items()})
+    
+    def set_ollama_options(self, options):
+        """把Ollama参数设置到界面上，未设置的参数清空"""
+        for name, var in self.ollama_option_vars.items():
+            var.set(str(options.get(name, "")))
+    
+    def create_generation_engine(self, prompt_template=None, pool_size=1, concurrency=None,
+                                 rate_limiter=None, retry_policy=None, cache=None, keep_alive=None):
+        """根据当前界面设置创建生成引擎（必须在主线程调用），Ollama参数无效时抛出ValueError"""
+        if prompt_template is None:
+            prompt_template = self.prompt_text.get("1.0", tk.END).strip()
+        return GenerationEngine(
+            api_type=self.api_type,
+            model=self.model_var.get(),
+            prompt_template=prompt_template,
+            api_key=self.api_key,
+            ollama_url=self.ollama_url,
+            pool_size=pool_size,
+            concurrency=concurrency,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            cache=cache,
+            cleaning_steps=self.get_cleaning_steps(),
+            base_url=self.openai_base_url,
+            ollama_options=self.get_ollama_options(),
+            keep_alive=keep_alive
+        )
     
     def replace_template_variables(self, template, variables):
         """替换模板中的变量"""
-        result = template
-        
-        # 替换简单变量 {变量名}
-        for var_name, var_value in variables.items():
-            pattern = r'\{' + re.escape(var_name) + r'\}'
-            result = re.sub(pattern, var_value, result)
-            
-        # 替换带条件的变量 {如果:变量名:内容}
-        for var_name, var_value in variables.items():
-            # 如果变量有值，则保留条件块内容
-            if var_value:
-                pattern = r'\{如果:' + re.escape(var_name) + r':(.*?)\}'
-                result = re.sub(pattern, r'\1', result)
-            else:
-                # 如果变量没有值，则移除整个条件块
-                pattern = r'\{如果:' + re.escape(var_name) + r':.*?\}'
-                result = re.sub(pattern, '', result)
-                
-        # 替换循环变量 (未来可扩展)
-        
-        return result
+        return replace_template_variables(template, variables)
 
     def generate_and_update(self):
         """生成内容并更新数据"""
@@ -812,8 +824,8 @@ class AIColumnGenerator:
         target_column = self.target_column_var.get()
         ref_columns = self.get_selected_ref_columns()
         
-        if not ref_columns:
-            messagebox.showwarning("警告", "请选择至少一个引用列")
+        if not ref_columns and not self.get_template_columns():
+            messagebox.showwarning("警告", "请选择至少一个引用列，或在提示语中使用{列名}占位符")
             return
             
         # 检查目标列
@@ -821,6 +833,13 @@ class AIColumnGenerator:
             messagebox.showwarning("警告", "请选择或创建写入列")
             self.show_new_column_dialog()
             return
+        
+        # 只加载引用列、模板占位符用到的列和写入列，写入列已有的内容需要保留
+        try:
+            self.load_table_columns(ref_columns + self.get_template_columns() + [target_column])
+        except Exception as e:
+            messagebox.showerror("错误", f"读取数据列时出错: {str(e)}")
+            return
             
         # 如果是新列但不在DataFrame中，则创建它
         if target_column not in self.df.columns:
@@ -836,11 +855,19 @@ class AIColumnGenerator:
         
         # 获取提示语模板
         prompt_template = self.prompt_text.get("1.0", tk.END).strip()
+        try:
+            self.get_ollama_options()
+        except ValueError as e:
+            messagebox.showerror("错误", str(e))
+            return
         
         # 创建进度窗口
         progress_window = tk.Toplevel(self.root)
         progress_window.title("处理中")
-        progress_window.geometry("450x280")
+        # 配置了多个接口时进度窗口逐行显示各接口的吞吐，窗口相应加高
+        endpoint_count = len(parse_endpoints(self.ollama_url if self.api_type == "ollama" else self.openai_base_url))
+        extra_height = 20 * endpoint_count if endpoint_count > 1 else 0
+        progress_window.geometry(f"450x{545 + extra_height}")
         
         ttk.Label(progress_window, text="正在生成内容，请稍候...").pack(pady=10)
         
@@ -851,13 +878,19 @@ class AIColumnGenerator:
         current_label = ttk.Label(progress_window, text="0/0")
         current_label.pack(pady=5)
         
-        # 添加延迟控制选项（仅对OpenAI API有用）
-        delay_var = tk.BooleanVar(value=False)
-        delay_frame = ttk.Frame(progress_window)
-        delay_frame.pack(fill=tk.X, padx=20, pady=5)
+        concurrency_label = ttk.Label(progress_window, text="")
+        concurrency_label.pack(pady=2)
+        
+        # 添加限速控制：所有线程共用每分钟请求数和令牌数额度（0表示不限制，OpenAI API推荐设置）
+        rate_frame = ttk.Frame(progress_window)
+        rate_frame.pack(fill=tk.X, padx=20, pady=5)
         
-        ttk.Checkbutton(delay_frame, text="添加延迟以避免API限制(OpenAI API推荐)", 
-                        variable=delay_var).pack(side=tk.LEFT)
+        ttk.Label(rate_frame, text="限速 每分钟请求数:").pack(side=tk.LEFT)
+        rpm_var = tk.IntVar(value=0)
+        ttk.Entry(rate_frame, textvariable=rpm_var, width=8).pack(side=tk.LEFT, padx=5)
+        ttk.Label(rate_frame, text="每分钟令牌数:").pack(side=tk.LEFT)
+        tpm_var = tk.IntVar(value=0)
+        ttk.Entry(rate_frame, textvariable=tpm_var, width=10).pack(side=tk.LEFT, padx=5)
         
         # 添加线程数量控制
         thread_frame = ttk.Frame(progress_window)
@@ -865,36 +898,149 @@ class AIColumnGenerator:
         
         ttk.Label(thread_frame, text="处理线程数:").pack(side=tk.LEFT)
         thread_var = tk.IntVar(value=4)  # 默认4线程
-        thread_spinbox = ttk.Spinbox(thread_frame, from_=1, to=8, width=5, textvariable=thread_var)
+        thread_spinbox = ttk.Spinbox(thread_frame, from_=1, to=64, width=5, textvariable=thread_var)
         thread_spinbox.pack(side=tk.LEFT, padx=5)
         
+        # 合并请求：多行合并为一次模型调用，适合输出很短的提取、分类类模板
+        ttk.Label(thread_frame, text="每次请求合并行数:").pack(side=tk.LEFT, padx=(15, 0))
+        pack_var = tk.IntVar(value=1)  # 默认不合并
+        ttk.Spinbox(thread_frame, from_=1, to=50, width=5, textvariable=pack_var).pack(side=tk.LEFT, padx=5)
+        
+        # 添加执行方式控制：多线程或asyncio异步引擎（适合大任务和远程API）
+        engine_frame = ttk.Frame(progress_window)
+        engine_frame.pack(fill=tk.X, padx=20, pady=5)
+        
+        engine_var = tk.StringVar(value="thread")
+        ttk.Radiobutton(engine_frame, text="多线程", value="thread", 
+                        variable=engine_var).pack(side=tk.LEFT)
+        ttk.Radiobutton(engine_frame, text="异步引擎", value="async", 
+                        variable=engine_var).pack(side=tk.LEFT, padx=5)
+        ttk.Label(engine_frame, text="最大并发请求数:").pack(side=tk.LEFT, padx=5)
+        in_flight_var = tk.IntVar(value=100)
+        in_flight_spinbox = ttk.Spinbox(engine_frame, from_=1, to=1000, width=5, textvariable=in_flight_var)
+        in_flight_spinbox.pack(side=tk.LEFT, padx=5)
+        
+        # 自适应并发：以线程数/最大并发请求数为上限，根据延迟和429/503自动调整
+        adaptive_var = tk.BooleanVar(value=False)
+        adaptive_frame = ttk.Frame(progress_window)
+        adaptive_frame.pack(fill=tk.X, padx=20, pady=5)
+        ttk.Checkbutton(adaptive_frame, text="自适应并发(根据延迟和限流自动调整，上面的数值作为上限)", 
+                        variable=adaptive_var).pack(side=tk.LEFT)
+        
+        # Ollama模型预热和保持加载时间：预热避免首批请求因加载模型超时，keep_alive留空使用Ollama的设置
+        warm_up_var = tk.BooleanVar(value=self.api_type == "ollama")
+        keep_alive_var = tk.StringVar()
+        if self.api_type == "ollama":
+            ollama_frame = ttk.Frame(progress_window)
+            ollama_frame.pack(fill=tk.X, padx=20, pady=5)
+            ttk.Checkbutton(ollama_frame, text="开始前预热模型", variable=warm_up_var).pack(side=tk.LEFT)
+            ttk.Label(ollama_frame, text="模型保持加载(如30m，-1为一直):").pack(side=tk.LEFT, padx=(15, 0))
+            ttk.Entry(ollama_frame, textvariable=keep_alive_var, width=8).pack(side=tk.LEFT, padx=5)
+        
+        # 上次生成有失败行时，允许只重试这些行
+        retry_failed_var = tk.BooleanVar(value=False)
+        if self.last_failures and self.last_failures_target == target_column:
+            retry_frame = ttk.Frame(progress_window)
+            retry_frame.pack(fill=tk.X, padx=20, pady=5)
+            ttk.Checkbutton(retry_frame, text=f"仅重试上次失败的行({len(self.last_failures)} 行)", 
+                            variable=retry_failed_var).pack(side=tk.LEFT)
+        
+        # 增量模式：只处理写入列为空或引用内容、模板、模型与上次不同的行
+        only_changed_var = tk.BooleanVar(value=False)
+        only_changed_frame = ttk.Frame(progress_window)
+        only_changed_frame.pack(fill=tk.X, padx=20, pady=5)
+        ttk.Checkbutton(only_changed_frame, text="仅处理写入列为空或引用内容已变化的行", 
+                        variable=only_changed_var).pack(side=tk.LEFT)
+        
+        # 检查点：生成结果定期追加到输入文件旁的检查点文件，中断后可以继续
+        checkpoint_frame = ttk.Frame(progress_window)
+        checkpoint_frame.pack(fill=tk.X, padx=20, pady=5)
+        
+        ttk.Label(checkpoint_frame, text="检查点写入间隔(行):").pack(side=tk.LEFT)
+        checkpoint_every_var = tk.IntVar(value=10)
+        ttk.Spinbox(checkpoint_frame, from_=1, to=1000, width=5, 
+                    textvariable=checkpoint_every_var).pack(side=tk.LEFT, padx=5)
+        
+        # 只列出与当前模板、模型和引用列一致的检查点，默认不勾选，由用户确认后再继续
+        resume_var = tk.BooleanVar(value=False)
+        signature = checkpoint_signature(prompt_template, self.model_var.get(), ref_columns)
+        try:
+            checkpoint_rows = len(load_checkpoint(checkpoint_path_for(self.file_path), target_column, signature))
+        except Exception:
+            checkpoint_rows = 0
+        if checkpoint_rows:
+            ttk.Checkbutton(checkpoint_frame, text=f"从检查点继续(已完成 {checkpoint_rows} 行)", 
+                            variable=resume_var).pack(side=tk.LEFT, padx=5)
+        
         # 添加批量大小控制
         batch_frame = ttk.Frame(progress_window)
         batch_frame.pack(fill=tk.X, padx=20, pady=5)
         
-        ttk.Label(batch_frame, text="UI更新频率(行):").pack(side=tk.LEFT)
-        batch_var = tk.IntVar(value=10)  # 默认每10行更新一次UI
-        batch_spinbox = ttk.Spinbox(batch_frame, from_=1, to=100, width=5, textvariable=batch_var)
-        batch_spinbox.pack(side=tk.LEFT, padx=5)
+        ttk.Label(batch_frame, text="界面刷新间隔(毫秒):").pack(side=tk.LEFT)
+        refresh_var = tk.IntVar(value=200)  # 默认每200毫秒刷新一次进度和预览
+        refresh_spinbox = ttk.Spinbox(batch_frame, from_=50, to=2000, increment=50, width=6,
+                                      textvariable=refresh_var)
+        refresh_spinbox.pack(side=tk.LEFT, padx=5)
         
         # 启动按钮
         start_button = ttk.Button(progress_window, text="开始处理", 
                                  command=lambda: self.start_processing(
-                                     progress_window, progress_var, current_label, 
+                                     progress_window, progress_var, current_label, concurrency_label,
                                      target_column, ref_columns, prompt_template,
-                                     delay_var.get(), thread_var.get(), batch_var.get()
+                                     {
+                                         "rpm": rpm_var.get(),
+                                         "tpm": tpm_var.get(),
+                                         "num_threads": thread_var.get(),
+                                         "pack_size": pack_var.get(),
+                                         "refresh_ms": refresh_var.get(),
+                                         "engine_mode": engine_var.get(),
+                                         "max_in_flight": in_flight_var.get(),
+                                         "adaptive": adaptive_var.get(),
+                                         "retry_failed": retry_failed_var.get(),
+                                         "checkpoint_every": checkpoint_every_var.get(),
+                                         "resume": resume_var.get(),
+                                         "only_changed": only_changed_var.get(),
+                                         "warm_up": warm_up_var.get(),
+                                         "keep_alive": parse_keep_alive(keep_alive_var.get()),
+                                     }
                                  ))
         start_button.pack(pady=10)
         
-    def start_processing(self, progress_window, progress_var, current_label,
-                       target_column, ref_columns, prompt_template,
-                       use_delay, num_threads, batch_size):
-        """启动多线程处理数据"""
-        total_rows = len(self.df)
-        
-        # 确保目标列在DataFrame中存在
-        if target_column not in self.df.columns:
-            self.df[target_column] = ""  # 创建新列
+    def start_processing(self, progress_window, progress_var, current_label, concurrency_label,
+                       target_column, ref_columns, prompt_template, options):
+        """启动多线程或异步引擎处理数据"""
+        rows = None
+        if options.get("retry_failed"):
+            rows = [failure["row"] for failure in self.last_failures]
+        
+        # 确保目标列在DataFrame中存在且可以写入文本
+        ensure_text_column(self.df, target_column)
+        
+        # 从检查点继续时先写回已完成的行，只处理剩余的行
+        checkpoint_path = checkpoint_path_for(self.file_path)
+        signature = checkpoint_signature(prompt_template, self.model_var.get(), ref_columns)
+        completed = {}
+        if options.get("resume"):
+            try:
+                completed = load_checkpoint(checkpoint_path, target_column, signature)
+            except Exception as e:
+                messagebox.showerror("错误", f"读取检查点时出错: {str(e)}")
+                return
+            rows = apply_checkpoint(self.df, target_column, completed, rows)
+        
+        placeholder_columns = self.get_template_columns(prompt_template)
+        fingerprint_columns = ref_columns + [col for col in placeholder_columns if col not in ref_columns]
+        fingerprints = compute_fingerprints(self.df, fingerprint_columns, prompt_template, self.model_var.get())
+        previous_fingerprints = self.get_previous_fingerprints(target_column)
+        if options.get("only_changed"):
+            rows = select_changed_rows(self.df, target_column, fingerprints, previous_fingerprints, rows)
+        try:
+            checkpoint = CheckpointWriter(checkpoint_path, target_column, options["checkpoint_every"],
+                                          append=options.get("resume", False) and bool(completed),
+                                          signature=signature)
+        except Exception as e:
+            checkpoint = None
+            self.status_var.set(f"无法写入检查点文件，本次不保存检查点: {str(e)}")
         
         # 禁用启动按钮，防止重复点击
         for widget in progress_window.winfo_children():
@@ -902,130 +1048,210 @@ class AIColumnGenerator:
                 widget.configure(state="disabled")
                 break
         
-        # 创建结果队列和进度队列
-        result_queue = queue.Queue()
-        progress_queue = queue.Queue()
-        
-        # 创建工作线程
-        threads = []
-        rows_per_thread = max(1, total_rows // num_threads)
+        # 创建生成任务并启动工作线程
+        if options["engine_mode"] == "async":
+            max_concurrency = options["max_in_flight"]
+        else:
+            max_concurrency = options["num_threads"]
+        concurrency = AdaptiveConcurrency(max_concurrency) if options["adaptive"] else None
+        rate_limiter = None
+        if options["rpm"] > 0 or options["tpm"] > 0:
+            rate_limiter = RateLimiter(options["rpm"], options["tpm"])
+        cache = self.open_response_cache()
+        engine = self.create_generation_engine(prompt_template, pool_size=max_concurrency,
+                                               concurrency=concurrency, rate_limiter=rate_limiter,
+                                               retry_policy=RetryPolicy(), cache=cache,
+                                               keep_alive=options.get("keep_alive"))
+        warm_up = options.get("warm_up", False) and self.api_type == "ollama"
+        if options["engine_mode"] == "async":
+            job = AsyncGenerationJob(engine, self.df, ref_columns, max_in_flight=options["max_in_flight"],
+                                     rows=rows, checkpoint=checkpoint, pack_size=options["pack_size"],
+                                     warm_up=warm_up)
+        else:
+            job = GenerationJob(engine, self.df, ref_columns, num_threads=options["num_threads"],
+                                rows=rows, checkpoint=checkpoint, pack_size=options["pack_size"],
+                                warm_up=warm_up)
+        total_rows = job.total_rows
+        result_queue = job.result_queue
+        progress_queue = job.progress_queue
+        job.start()
+        
+        # 在Tk主线程上用after()定时拉取结果，所有界面操作都在主线程完成
+        results = {}
+        meter = ProgressMeter(total_rows)
+        refresh_ms = max(20, options["refresh_ms"])
+        state = {"processed": 0, "last_content": "", "preview_processed": -1}
+        
+        def apply_results():
+            """将已收到的结果应用到数据框，出错时也保留已完成的部分"""
+            for idx, content in results.items():
+                self.df.at[idx, target_column] = content
+            self.last_failures = list(job.failures)
+            self.last_failures_target = target_column
+            self.row_fingerprints[target_column] = update_fingerprints(
+                previous_fingerprints, fingerprints, job.completed_rows + list(completed))
+        
+        def finish(error=None):
+            """任务结束：写回结果、释放连接并提示用户"""
+            try:
+                try:
+                    apply_results()
+                except Exception as e:
+                    error = error or e
+                progress_window.destroy()
+                if error is not None:
+                    messagebox.showerror("错误", f"处理数据时出错: {str(error)}\n已完成的 {len(results)} 行结果已保留")
+                    self.status_var.set("处理数据失败")
+                    return
+                elapsed = max(meter.elapsed(), 1e-6)
+                cache_text = f"，{cache.stats_text()}" if cache is not None else ""
+                if job.total_requests < total_rows:
+                    cache_text = f"，去重后请求 {job.total_requests} 次{cache_text}"
+                self.status_var.set(f"已完成处理 {len(results)} 行数据，用时 {elapsed:.1f} 秒 ({len(results) / elapsed:.2f} 行/秒){cache_text}")
+                if job.failures:
+                    self.show_failures(job.failures)
+                    messagebox.showwarning("部分失败", 
+                                           f"成功处理 {len(results)} 行数据，{len(job.failures)} 行重试后仍失败。\n"
+                                           f"可再次点击\"生成并更新\"并勾选\"仅重试上次失败的行\"。")
+                else:
+                    messagebox.showinfo("成功", f"成功处理 {len(results)} 行数据")
+            finally:
+                engine.close()
+                if cache is not None:
+                    cache.close()
+                if checkpoint is not None:
+                    checkpoint.close()
+                    # 与命令行一致：任务正常结束后结果已写回表格，检查点不再需要
+                    if error is None and os.path.exists(checkpoint_path):
+                        try:
+                            os.remove(checkpoint_path)
+                        except OSError:
+                            pass
+        
+        def drain(source, limit):
+            """从队列中最多取出 limit 项，不阻塞"""
+            items = []
+            while len(items) < limit:
+                try:
+                    items.append(source.get_nowait())
+                except queue.Empty:
+                    break
+            return items
         
-        # 将数据分配给各个线程
-        for t in range(num_threads):
-            start_idx = t * rows_per_thread
-            end_idx = (t + 1) * rows_per_thread if t < num_threads - 1 else total_rows
-            
-            thread = threading.Thread(
-                target=self.process_rows,
-                args=(
-                    start_idx, end_idx, ref_columns, prompt_template,
-                    use_delay, result_queue, progress_queue
-                )
-            )
-            thread.daemon = True  # 设置为守护线程
-            threads.append(thread)
-        
-        # 启动所有工作线程
-        for thread in threads:
-            thread.start()
-        
-        # 创建更新UI的函数
-        def update_ui():
-            processed = 0
-            results = {}
-            last_content = ""
-            
+        def pump():
             try:
-                # 检查进度队列和结果队列
-                while processed < total_rows:
-                    # 处理所有可用的进度更新
-                    progress_updates = 0
-                    while not progress_queue.empty() and processed < total_rows:
-                        # 获取一个进度更新
-                        progress_queue.get()
-                        progress_updates += 1
-                    
-                    # 更新进度计数，确保不超过总行数
-                    processed += progress_updates
-                    processed = min(processed, total_rows)  # 确保不超过总行数
-                    
-                    # 更新进度条和标签
-                    progress = (processed / total_rows) * 100
-                    progress_var.set(progress)
-                    current_label.config(text=f"{processed}/{total_rows}")
-                    
-                    # 处理所有可用的结果
-                    while not result_queue.empty():
-                        idx, content = result_queue.get()
-                        if idx == "ERROR":
-                            # 处理错误情况
-                            raise Exception(content)
-                        
-                        results[idx] = content
-                        last_content = content  # 保存最近的内容用于显示
-                        
-                    # 更新最新处理的内容到预览区域
-                    if progress_updates > 0 and (processed % batch_size == 0 or processed == total_rows):
-                        self.preview_text.delete("1.0", tk.END)
-                        self.preview_text.insert(tk.END, f"已处理 {processed}/{total_rows} 行\n\n")
-                        if last_content:
-                            self.preview_text.insert(tk.END, f"最近一行生成内容:\n{last_content}")
-                    
-                    # 检查线程是否全部完成
-                    active_threads = sum(1 for t in threads if t.is_alive())
-                    if active_threads == 0 and len(results) >= total_rows:
-                        break
-                    
-                    # 更新UI
-                    self.root.update()
-                    time.sleep(0.1)  # 短暂延迟避免UI卡顿
+                # 每次最多处理固定数量的进度信号和结果，大量工作线程同时返回时界面也不会卡住
+                state["processed"] = min(state["processed"] + len(drain(progress_queue, UI_MAX_ITEMS_PER_TICK)),
+                                         total_rows)
+                for idx, content in drain(result_queue, UI_MAX_ITEMS_PER_TICK):
+                    if idx == "ERROR":
+                        raise Exception(content)
+                    results[idx] = content
+                    state["last_content"] = content  # 保存最近的内容用于显示
                 
-                # 将结果应用到数据框
-                for idx, content in results.items():
-                    self.df.at[idx, target_column] = content
+                processed = state["processed"]
+                meter.update(processed)
+                progress_var.set(processed / total_rows * 100 if total_rows else 100)
+                failed_text = f"，失败 {len(job.failures)} 行" if job.failures else ""
+                current_label.config(text=meter.status_text() + failed_text)
+                status_parts = []
+                if job.status_message:
+                    status_parts.append(job.status_message)
+                if job.total_requests < total_rows:
+                    status_parts.append(f"去重后请求: {job.completed_requests}/{job.total_requests}")
+                if concurrency is not None:
+                    status_parts.append(
+                        f"当前并发: {concurrency.limit}/{concurrency.max_limit} (在途请求 {concurrency.in_flight})")
+                if cache is not None:
+                    status_parts.append(cache.stats_text())
+                if engine.endpoints is not None:
+                    status_parts.extend(engine.endpoints.stats_lines())
+                if status_parts:
+                    concurrency_label.config(text="\n".join(status_parts))
                 
-                # 所有处理完成
-                progress_window.destroy()
-                messagebox.showinfo("成功", f"成功处理 {len(results)} 行数据")
-                self.status_var.set(f"已完成处理 {len(results)} 行数据")
+                # 预览区每个刷新周期最多重绘一次，只显示最近一行
+                if processed != state["preview_processed"]:
+                    state["preview_processed"] = processed
+                    self.preview_text.delete("1.0", tk.END)
+                    self.preview_text.insert(tk.END, f"已处理 {processed}/{total_rows} 行\n\n")
+                    if state["last_content"]:
+                        self.preview_text.insert(tk.END, f"最近一行生成内容:\n{state['last_content']}")
                 
+                # 工作线程全部结束且结果已取完时任务完成
+                if not job.is_running() and result_queue.empty():
+                    finish()
+                    return
             except Exception as e:
-                progress_window.destroy()
-                messagebox.showerror("错误", f"处理数据时出错: {str(e)}")
-                self.status_var.set("处理数据失败")
+                finish(e)
+                return
+            self.root.after(refresh_ms, pump)
         
-        # 启动UI更新线程
-        ui_thread = threading.Thread(target=update_ui)
-        ui_thread.daemon = True
-        ui_thread.start()
+        self.root.after(refresh_ms, pump)
 
-    def process_rows(self, start_idx, end_idx, ref_columns, prompt_template,
-                   use_delay, result_queue, progress_queue):
-        """处理指定范围的行（在工作线程中运行）"""
+    def get_previous_fingerprints(self, target_column):
+        """获取写入列上次的行指纹：优先使用本次会话中的结果，否则读取文件旁的指纹文件"""
+        if self.row_fingerprints_file != self.file_path:
+            self.row_fingerprints = {}
+            self.row_fingerprints_file = self.file_path
+        if target_column not in self.row_fingerprints:
+            try:
+                self.row_fingerprints[target_column] = load_fingerprints(
+                    fingerprint_path_for(self.file_path), target_column)
+            except Exception:
+                self.row_fingerprints[target_column] = []
+        return self.row_fingerprints[target_column]
+    
+    def save_row_fingerprints(self, export_path):
+        """把各写入列的行指纹保存到导出文件旁"""
+        if self.row_fingerprints_file != self.file_path:
+            return
         try:
-            for i in range(start_idx, end_idx):
-                # 获取当前行
-                index = self.df.index[i]
-                row = self.df.iloc[i]
-                
-                # 生成提示语
-                ref_content = "\n".join([f"{col}: {row[col]}" for col in ref_columns])
-                prompt = prompt_template.replace("{引用内容}", ref_content)
-                
-                # 调用API生成内容
-                generated_content = self.generate_content_with_ai(ref_content)
-                
-                # 将结果放入队列
-                result_queue.put((index, generated_content))
-                progress_queue.put(1)  # 表示完成了一行，只发送一个信号
-                
-                # 根据API类型和用户选择决定是否添加延迟
-                if use_delay and self.api_type_var.get() == "openai":
-                    time.sleep(0.5)  # 仅对OpenAI API添加延迟
-                
+            for target_column, fingerprints in self.row_fingerprints.items():
+                save_fingerprints(fingerprint_path_for(export_path), target_column, fingerprints)
+        except Exception as e:
+            self.status_var.set(f"保存行指纹时出错: {str(e)}")
+    
+    def show_failures(self, failures):
+        """在预览区域列出失败的行"""
+        self.preview_text.delete("1.0", tk.END)
+        self.preview_text.insert(tk.END, f"以下 {len(failures)} 行重试后仍失败：\n\n")
+        for failure in sorted(failures, key=lambda f: f["row"])[:200]:
+            self.preview_text.insert(tk.END, 
+                                     f"第 {failure['row'] + 1} 行 [{failure['status']}] "
+                                     f"尝试 {failure['attempts']} 次: {failure['error']}\n")
+        if len(failures) > 200:
+            self.preview_text.insert(tk.END, f"... 其余 {len(failures) - 200} 行未显示\n")
+
+    def export_prompts(self):
+        """导出当前模板下每行渲染后的提示词，便于在生成前检查"""
+        if self.df is None:
+            messagebox.showwarning("警告", "请先选择文件")
+            return
+        
+        ref_columns = self.get_selected_ref_columns()
+        if not ref_columns and not self.get_template_columns():
+            messagebox.showwarning("警告", "请选择至少一个引用列，或在提示语中使用{列名}占位符")
+            return
+        
+        export_path = filedialog.asksaveasfilename(
+            title="导出提示词",
+            defaultextension=".csv",
+            filetypes=[("CSV文件", "*.csv"), ("Excel文件", "*.xlsx"), ("Parquet文件", "*.parquet")]
+        )
+        if not export_path:
+            return
+        
+        try:
+            placeholder_columns = self.get_template_columns()
+            self.load_table_columns(ref_columns + placeholder_columns)
+            references = build_reference_contents(self.df, ref_columns)
+            column_values = {col: self.df[col].tolist() for col in placeholder_columns}
+            prompts = self.create_generation_engine().render_prompts(references, column_values)
+            write_table(pd.DataFrame({"行号": range(1, len(prompts) + 1), "提示词": prompts}), export_path)
+            messagebox.showinfo("成功", f"已导出 {len(prompts)} 行提示词(去重后 {len(set(prompts))} 条)")
+            self.status_var.set(f"提示词已导出到: {os.path.basename(export_path)}")
         except Exception as e:
-            # 将异常信息加入结果队列
-            result_queue.put(("ERROR", str(e)))
+            messagebox.showerror("错误", f"导出提示词时出错: {str(e)}")
     
     def export_file(self):
         """导出处理后的文件"""
@@ -1036,13 +1262,15 @@ class AIColumnGenerator:
         export_path = filedialog.asksaveasfilename(
             title="保存文件",
             defaultextension=".xlsx",
-            filetypes=[("Excel文件", "*.xlsx"), ("CSV文件", "*.csv")]
+            filetypes=[("Excel文件", "*.xlsx"), ("CSV文件", "*.csv"),
+                       ("Parquet文件", "*.parquet"), ("Feather文件", "*.feather")]
         )
         
         if not export_path:
             return
         
         try:
+            export_df = self.get_export_dataframe()
             if export_path.endswith('.csv'):
                 # 允许用户选择导出编码
                 encoding_window = tk.Toplevel(self.root)
@@ -1061,7 +1289,8 @@ class AIColumnGenerator:
                 def confirm_encoding():
                     nonlocal encoding_var
                     try:
-                        self.df.to_csv(export_path, index=False, encoding=encoding_var.get())
+                        export_df.to_csv(export_path, index=False, encoding=encoding_var.get())
+                        self.save_row_fingerprints(export_path)
                         messagebox.showinfo("成功", f"文件已成功导出到: {export_path}")
                         self.status_var.set(f"文件已导出 (编码: {encoding_var.get()})")
                         encoding_window.destroy()
@@ -1074,7 +1303,8 @@ class AIColumnGenerator:
                 # 等待窗口关闭
                 self.root.wait_window(encoding_window)
             else:
-                self.df.to_excel(export_path, index=False)
+                write_table(export_df, export_path)
+                self.save_row_fingerprints(export_path)
                 messagebox.showinfo("成功", f"文件已成功导出到: {export_path}")
                 self.status_var.set(f"文件已导出")
         except Exception as e:
@@ -1085,18 +1315,19 @@ class AIColumnGenerator:
         """选择Excel或CSV文件并手动指定编码"""
         file_path = filedialog.askopenfilename(
             title="选择Excel或CSV文件",
-            filetypes=[("Excel文件", "*.xlsx *.xls"), ("CSV文件", "*.csv"), ("所有文件", "*.*")]
+            filetypes=[("Excel文件", "*.xlsx *.xls"), ("CSV文件", "*.csv"),
+                       ("Parquet/Feather文件", "*.parquet *.feather *.arrow"), ("所有文件", "*.*")]
         )
         
         if not file_path:
             return
             
-        # 如果选择的是Excel文件，直接读取
-        if file_path.endswith(('.xlsx', '.xls')):
+        # 如果选择的是Excel或列式文件，直接读取
+        if file_path.endswith(('.xlsx', '.xls') + COLUMNAR_EXTENSIONS):
             try:
                 self.file_path = file_path
                 self.file_label.config(text=os.path.basename(file_path))
-                self.df = pd.read_excel(file_path)
+                self.open_table(file_path)
                 self.update_column_selections()
                 messagebox.showinfo("成功", f"成功加载Excel文件，共 {len(self.df)} 行数据")
                 self.status_var.set(f"已加载文件: {os.path.basename(file_path)}")
@@ -1154,7 +1385,7 @@ class AIColumnGenerator:
                 self.file_path = file_path
                 self.file_label.config(text=os.path.basename(file_path))
                 
-                self.df = pd.read_csv(file_path, encoding=encoding)
+                self.open_table(file_path, encoding)
                 self.update_column_selections()
                 
                 messagebox.showinfo("成功", f"成功加载CSV文件，共 {len(self.df)} 行数据")
@@ -1281,22 +1512,41 @@ CSV文件编码常见问题与解决方案
         self.save_config()
 
     def test_ollama_connection(self):
-        """测试Ollama连接"""
-        try:
-            response = requests.get(self.ollama_url)
-            if response.status_code == 200:
-                messagebox.showinfo("成功", "Ollama连接测试成功")
-            else:
-                messagebox.showerror("错误", f"Ollama连接测试失败，状态码: {response.status_code}")
-        except Exception as e:
-            messagebox.showerror("错误", f"测试Ollama连接时出错: {str(e)}")
+        """测试Ollama连接，填写了多个地址时逐个测试"""
+        urls = parse_endpoints(self.ollama_url)
+        if len(urls) <= 1:
+            try:
+                response = requests.get(self.ollama_url)
+                if response.status_code == 200:
+                    messagebox.showinfo("成功", "Ollama连接测试成功")
+                else:
+                    messagebox.showerror("错误", f"Ollama连接测试失败，状态码: {response.status_code}")
+            except Exception as e:
+                messagebox.showerror("错误", f"测试Ollama连接时出错: {str(e)}")
+            return
+        
+        lines = []
+        failed = False
+        for url in urls:
+            try:
+                response = requests.get(url, timeout=10)
+                ok = response.status_code == 200
+                lines.append(f"{url}: {'成功' if ok else f'状态码 {response.status_code}'}")
+            except Exception as e:
+                ok = False
+                lines.append(f"{url}: 出错 {str(e)}")
+            failed = failed or not ok
+        if failed:
+            messagebox.showerror("错误", "部分Ollama地址连接失败:\n" + "\n".join(lines))
+        else:
+            messagebox.showinfo("成功", "Ollama连接测试成功:\n" + "\n".join(lines))
     
     def list_ollama_models(self, auto_update=False):
         """获取Ollama模型列表"""
         try:
-            ollama_url = self.ollama_url_var.get().strip()
-            if not ollama_url:
-                ollama_url = "http://localhost:11434"
+            # 填写了多个地址时从第一个地址获取模型列表
+            urls = parse_endpoints(self.ollama_url_var.get())
+            ollama_url = urls[0] if urls else "http://localhost:11434"
             
             # 先尝试新的API端点
             try:    
@@ -1386,7 +1636,7 @@ CSV文件编码常见问题与解决方案
                 return
                 
             # 检查列名是否已存在
-            if new_name in self.df.columns:
+            if new_name in self.get_all_columns():
                 overwrite = messagebox.askyesno("列已存在", 
                                               f"列名 '{new_name}' 已存在，是否使用此列？", 
                                               parent=dialog)
@@ -1434,19 +1684,22 @@ CSV文件编码常见问题与解决方案
             
         # 从预设模板或用户模板中获取内容
         template_content = ""
+        cleaning_steps = default_cleaning_steps()
+        ollama_options = {}
         if template_name in self.preset_templates:
             template_content = self.preset_templates[template_name]
         elif template_name in self.templates:
             # 兼容旧格式的模板
-            if isinstance(self.templates[template_name], str):
-                template_content = self.templates[template_name]
-            else:
-                template_content = self.templates[template_name]["content"]
+            template_content = get_template_content(self.templates[template_name])
+            cleaning_steps = get_template_cleaning(self.templates[template_name])
+            ollama_options = get_template_options(self.templates[template_name])
         
         if template_content:
             # 更新提示语编辑框的内容
             self.prompt_text.delete("1.0", tk.END)
             self.prompt_text.insert(tk.END, template_content)
+            self.set_cleaning_steps(cleaning_steps)
+            self.set_ollama_options(ollama_options)
             self.status_var.set(f"已加载模板: {template_name}")
     
     def save_template(self):
@@ -1496,10 +1749,18 @@ CSV文件编码常见问题与解决方案
                 if not overwrite:
                     return
             
+            try:
+                ollama_options = self.get_ollama_options()
+            except ValueError as e:
+                messagebox.showerror("错误", str(e), parent=dialog)
+                return
+            
             # 准备模板数据
             template_data = {
                 "content": prompt_content,
                 "description": desc_var.get().strip(),
+                "cleaning": self.get_cleaning_steps(),
+                "options": ollama_options,
                 "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
             }
             
@@ -1836,6 +2097,8 @@ CSV文件编码常见问题与解决方案
 1. 基本变量:
    使用 {变量名} 语法引用变量。例如:
    • {引用内容} - 将被替换为选中的引用列中的内容
+   • {列名} - 直接替换为本行该列的值，例如 {诊断}、{主诉}，
+     这样可以在一个提示词中分别引用多列，而不必使用"列名: 值"的拼接格式
 
 2. 条件变量:
    使用 {如果:变量名:内容} 语法创建条件块。
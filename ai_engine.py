@@ -0,0 +1,1946 @@
+import os
+import configparser
+import json
+import threading  # 用于多线程处理
+import queue  # 用于线程间通信
+import asyncio  # 用于异步生成引擎
+import time
+import math
+import collections
+import functools
+import random
+import re
+import requests  # 用于Ollama API请求
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from openai import OpenAI
+from response_cache import make_cache_key
+
+# 与界面无关的生成核心：图形界面和命令行共用同一套提示词渲染、AI调用和输出清理逻辑
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"  # Ollama默认API地址
+
+DEFAULT_SYSTEM_MESSAGE = "你是一个专业的内容生成助手，仅输出最终结果，不要包含思考过程。"
+MEDICAL_SYSTEM_MESSAGE = "你是一个医疗数据提取专家。只提取最终的数据结果，不要包含任何解释、思考过程或额外文字。对于血压数据，只返回格式为'血压X/YmmHg'的结果。"
+
+PRESET_TEMPLATES = {
+    "摘要生成": "请根据以下内容生成一段简洁的摘要：\n\n{引用内容}",
+    "内容翻译": "请将以下内容翻译成英文：\n\n{引用内容}",
+    "情感分析": "请分析以下内容的情感倾向(积极、消极或中性)，并给出理由：\n\n{引用内容}",
+    "关键词提取": "请从以下内容中提取5个最重要的关键词或短语：\n\n{引用内容}",
+    "内容分类": "请将以下内容分类到最合适的类别(例如：科技、健康、教育、娱乐等)，并说明理由：\n\n{引用内容}",
+    "观点提取": "请从以下内容中提取主要观点和论点：\n\n{引用内容}",
+    "问题回答": "请根据以下内容回答问题：\n{如果:问题:问题: {问题}\n\n}参考内容:\n{引用内容}",
+    "数据提取": "请从以下文本中提取所有数字数据，并按类别整理：\n\n{引用内容}",
+    "简介生成": "请根据以下内容生成一段专业的产品/服务简介，突出其主要特点和价值：\n\n{引用内容}",
+    "医学报告分析": "请分析以下医学报告内容，提取关键指标并解释其含义：\n\n{引用内容}",
+    "技术文档简化": "请将以下技术文档内容转换为普通用户容易理解的语言：\n\n{引用内容}",
+    "学术摘要": "请将以下学术内容生成一段摘要，包含研究目的、方法、结果和结论：\n\n{引用内容}",
+    "血压数据提取": "请从以下医疗记录中提取患者的血压数据，只返回血压值，格式为'血压X/YmmHg'：\n\n{引用内容}"
+}
+
+
+def load_api_config(config_path='config.ini'):
+    """读取配置文件中的API设置，返回(api_key, ollama_url, api_type)"""
+    api_key = None
+    ollama_url = DEFAULT_OLLAMA_URL
+    api_type = "openai"
+
+    config = configparser.ConfigParser()
+    if os.path.exists(config_path):
+        config.read(config_path)
+        if 'API' in config:
+            if 'openai_api_key' in config['API']:
+                api_key = config['API']['openai_api_key']
+            if 'ollama_url' in config['API']:
+                ollama_url = config['API']['ollama_url']
+            if 'api_type' in config['API']:
+                api_type = config['API']['api_type']
+
+    if not api_key and api_type == 'openai':
+        # 如果没有找到API密钥，则从环境变量中获取
+        api_key = os.environ.get('OPENAI_API_KEY')
+
+    return api_key, ollama_url, api_type
+
+
+def load_openai_base_url(config_path='config.ini'):
+    """读取配置文件中的OpenAI兼容接口地址(openai_base_url)，未设置时返回None"""
+    config = configparser.ConfigParser()
+    if os.path.exists(config_path):
+        config.read(config_path)
+        if 'API' in config and config['API'].get('openai_base_url'):
+            return config['API']['openai_base_url']
+    return None
+
+
+def load_user_templates(templates_path='prompt_templates.json'):
+    """加载用户保存的提示词模板"""
+    if os.path.exists(templates_path):
+        try:
+            with open(templates_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    return {}
+
+
+def get_template_content(template_data):
+    """获取模板内容，兼容旧格式(字符串)和新格式(字典)的模板"""
+    if isinstance(template_data, str):
+        return template_data
+    return template_data.get("content", "")
+
+
+# 模板中可以设置的常用Ollama参数及其类型，其他参数的值按JSON解析后传给Ollama
+OLLAMA_OPTION_TYPES = {
+    "num_ctx": int,
+    "num_predict": int,
+    "num_thread": int,
+    "temperature": float,
+}
+WARM_UP_TIMEOUT = 600  # 预热请求包含模型加载时间，超时设置得较长
+HEALTH_CHECK_INTERVAL = 15  # 配置多个接口时健康检查的间隔(秒)
+HEALTH_CHECK_TIMEOUT = 5  # 健康检查请求的超时(秒)
+EJECT_AFTER_FAILURES = 2  # 接口连续超时或连接失败多少次后被移除
+
+
+def get_template_options(template_data):
+    """获取模板保存的Ollama参数(options)，旧格式模板和未设置的模板返回空字典"""
+    if isinstance(template_data, dict):
+        return dict(template_data.get("options") or {})
+    return {}
+
+
+def parse_ollama_options(values):
+    """把 {参数名: 文本} 转换为Ollama参数，空文本跳过，数值无效时抛出ValueError
+
+    其他参数按JSON解析(如 top_k=40 得到整数，stop=["\\n"] 得到列表)，无法解析时作为文本传递。
+    模板中保存的非文本值(已是数值或列表)直接使用。
+    """
+    options = {}
+    for name, text in values.items():
+        if not isinstance(text, str) and name not in OLLAMA_OPTION_TYPES:
+            options[name] = text
+            continue
+        text = str(text).strip()
+        if not text:
+            continue
+        value_type = OLLAMA_OPTION_TYPES.get(name)
+        if value_type is None:
+            try:
+                options[name] = json.loads(text)
+            except ValueError:
+                options[name] = text
+            continue
+        try:
+            options[name] = value_type(text)
+        except ValueError:
+            raise ValueError(f"Ollama参数 {name} 的值无效: {text}")
+    return options
+
+
+def parse_keep_alive(value):
+    """解析keep_alive：纯数字为秒数(-1表示一直保持加载)，其他如"30m"原样传给Ollama，空值返回None"""
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def is_blood_pressure_prompt(text):
+    """判断提示词是否为血压数据提取任务"""
+    text = text.lower()
+    return '血压' in text or '收缩压' in text or '舒张压' in text
+
+
+def build_system_message(prompt):
+    """根据提示词内容选择系统消息"""
+    # 检查是否为医疗数据提取，特别是血压数据
+    if is_blood_pressure_prompt(prompt):
+        return MEDICAL_SYSTEM_MESSAGE
+    return DEFAULT_SYSTEM_MESSAGE
+
+
+CONDITION_PREFIX = "{如果:"
+
+
+def parse_template(template, start=0, in_condition=False):
+    """把模板解析为渲染计划，返回(节点列表, 结束位置)
+
+    节点为 ("text", 文本)、("var", 变量名) 或 ("if", 变量名, 子节点列表)。条件块内容中可以
+    再使用变量，花括号按层级配对。解析 in_condition 时遇到未闭合的条件块返回 (None, None)，
+    由调用方把它当作普通文本。
+    """
+    nodes = []
+    text = []
+    i = start
+    while i < len(template):
+        char = template[i]
+        if char == '}' and in_condition:
+            if text:
+                nodes.append(("text", "".join(text)))
+            return nodes, i + 1
+        if char == '{':
+            if template.startswith(CONDITION_PREFIX, i):
+                name_start = i + len(CONDITION_PREFIX)
+                name_end = template.find(':', name_start)
+                name = template[name_start:name_end]
+                if name_end != -1 and name and not any(c in name for c in '{}\n'):
+                    children, end = parse_template(template, name_end + 1, in_condition=True)
+                    if children is not None:
+                        if text:
+                            nodes.append(("text", "".join(text)))
+                            text = []
+                        nodes.append(("if", name, children))
+                        i = end
+                        continue
+            else:
+                close = template.find('}', i + 1)
+                name = template[i + 1:close]
+                if close != -1 and name and not any(c in name for c in '{\n'):
+                    if text:
+                        nodes.append(("text", "".join(text)))
+                        text = []
+                    nodes.append(("var", name))
+                    i = close + 1
+                    continue
+        text.append(char)
+        i += 1
+
+    if in_condition:
+        return None, None
+    if text:
+        nodes.append(("text", "".join(text)))
+    return nodes, i
+
+
+def template_value(value):
+    """把变量值转换为插入模板的文本，空值(None/NaN)为空字符串"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return str(value)
+
+
+class CompiledTemplate:
+    """预编译的提示词模板
+
+    {变量} 和 {如果:变量:内容} 只在编译时解析一次，渲染时按计划拼接字符串。变量值按原样
+    插入，不会像正则替换那样解释其中的反斜杠。未提供的 {变量} 原样保留(提示词中的JSON
+    示例等不受影响)；{如果:变量:内容} 在变量为空或未提供时整块移除。
+    """
+    def __init__(self, template):
+        self.template = template
+        self.nodes, _ = parse_template(template)
+        self.variables = []  # 模板中出现的变量名，按首次出现的顺序
+        self._collect_variables(self.nodes)
+
+    def _collect_variables(self, nodes):
+        for node in nodes:
+            if node[0] != "text" and node[1] not in self.variables:
+                self.variables.append(node[1])
+            if node[0] == "if":
+                self._collect_variables(node[2])
+
+    def render(self, variables):
+        """用变量字典渲染模板"""
+        parts = []
+        self._render_nodes(self.nodes, variables, parts)
+        return "".join(parts)
+
+    def _render_nodes(self, nodes, variables, parts):
+        for node in nodes:
+            kind = node[0]
+            if kind == "text":
+                parts.append(node[1])
+            elif kind == "var":
+                if node[1] in variables:
+                    parts.append(template_value(variables[node[1]]))
+                else:
+                    parts.append("{" + node[1] + "}")
+            elif template_value(variables.get(node[1])):
+                self._render_nodes(node[2], variables, parts)
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template):
+    """编译提示词模板(同一模板只编译一次)"""
+    return CompiledTemplate(template)
+
+
+def template_columns(template, columns):
+    """模板中直接引用的数据列，如 {诊断}，按模板中出现的顺序返回"""
+    available = set(columns)
+    return [name for name in compile_template(template).variables
+            if name in available and name != "引用内容"]
+
+
+def replace_template_variables(template, variables):
+    """替换模板中的变量"""
+    return compile_template(template).render(variables)
+
+
+# 输出清理步骤：(步骤名, 显示名称)，按此顺序执行
+CLEANING_STEPS = [
+    ("strip_reasoning", "去除思考过程"),
+    ("strip_preamble", "去除开场白和附注"),
+    ("extract_bp", "血压任务只保留血压值"),
+    ("trim", "压缩空行并去除首尾空白"),
+]
+
+# 清理用的正则在模块加载时编译一次，各工作线程共用(编译后的模式对象是线程安全的)
+THINK_BLOCK_PATTERN = re.compile(r"<think>.*?</think>\s*", re.DOTALL)
+REASONING_LINE_PATTERN = re.compile(r"^(好的|嗯|我来|让我|首先|思考|理解中|分析中|处理中).*?\n", re.MULTILINE)
+PREAMBLE_LINE_PATTERN = re.compile(r"^(这是|以下是|根据|分析|结果如下).*?\n", re.MULTILINE)
+TRAILING_NOTE_PATTERN = re.compile(r"\n*(根据提供的|参考文献|引用来源|注意事项|补充说明).*$", re.MULTILINE)
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+BLOOD_PRESSURE_PATTERN = re.compile(r'(\d{2,3}/\d{2,3})(?:\s*(?:mmHg|毫米汞柱))')
+
+
+def default_cleaning_steps():
+    """默认启用全部清理步骤"""
+    return {name: True for name, _ in CLEANING_STEPS}
+
+
+def get_template_cleaning(template_data):
+    """获取模板保存的清理步骤开关，旧格式模板和未保存开关的模板使用默认值"""
+    steps = default_cleaning_steps()
+    if isinstance(template_data, dict):
+        steps.update({name: bool(enabled) for name, enabled in template_data.get("cleaning", {}).items()
+                      if name in steps})
+    return steps
+
+
+class OutputCleaner:
+    """AI输出清理流水线
+
+    在任务开始时按模板配置一次：steps 为 {步骤名: 是否启用}，未给出的步骤按默认启用；
+    血压提取步骤只在模板为血压提取任务时生效。clean() 只依次调用已启用的步骤，
+    不读取任何界面状态，可在工作线程中并发调用。
+    """
+    def __init__(self, prompt_template="", steps=None):
+        self.steps = default_cleaning_steps()
+        if steps:
+            self.steps.update(steps)
+        if not is_blood_pressure_prompt(prompt_template):
+            self.steps["extract_bp"] = False
+        self.pipeline = [getattr(self, name) for name, _ in CLEANING_STEPS if self.steps[name]]
+
+    def clean(self, text):
+        """按顺序执行已启用的清理步骤"""
+        for step in self.pipeline:
+            text = step(text)
+        return text
+
+    @staticmethod
+    def strip_reasoning(text):
+        """去除<think>思考块和以思考用语开头的行"""
+        text = THINK_BLOCK_PATTERN.sub("", text)
+        return REASONING_LINE_PATTERN.sub("", text)
+
+    @staticmethod
+    def strip_preamble(text):
+        """去除"以下是..."之类的开场白行和末尾的参考来源、补充说明"""
+        text = PREAMBLE_LINE_PATTERN.sub("", text)
+        return TRAILING_NOTE_PATTERN.sub("", text)
+
+    @staticmethod
+    def extract_bp(text):
+        """找到血压值时只返回血压值"""
+        match = BLOOD_PRESSURE_PATTERN.search(BLANK_LINES_PATTERN.sub('\n\n', text))
+        if match:
+            return f"血压{match.group(1)}mmHg"
+        return text
+
+    @staticmethod
+    def trim(text):
+        """压缩多余的空行并去除首尾空白"""
+        return BLANK_LINES_PATTERN.sub('\n\n', text).strip()
+
+
+def clean_ai_output(text, prompt_template="", steps=None):
+    """清理AI输出，去除思考过程等多余内容"""
+    return OutputCleaner(prompt_template, steps).clean(text)
+
+
+PACKED_PROMPT_HEADER = (
+    "下面有{count}项相互独立的任务，请分别完成每一项。\n"
+    "只输出一个JSON数组，数组中按顺序包含{count}个字符串，第N个字符串是第N项任务的结果，"
+    "不要输出数组以外的任何内容。"
+)
+CODE_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def build_packed_prompt(prompts):
+    """把多行的提示词合并为一个编号的请求，要求模型以JSON数组返回各项结果"""
+    parts = [PACKED_PROMPT_HEADER.format(count=len(prompts))]
+    for number, prompt in enumerate(prompts, 1):
+        parts.append(f"### 第{number}项\n{prompt}")
+    return "\n\n".join(parts)
+
+
+def packed_system_message(prompts):
+    """合并请求使用的系统消息：各行单独请求时的系统消息相同时返回该消息，否则返回None
+
+    系统消息按每行自己的提示词选择(而不是合并后的文本)，缓存键中的系统消息才与实际发送的一致。
+    """
+    messages = {build_system_message(prompt) for prompt in prompts}
+    return messages.pop() if len(messages) == 1 else None
+
+
+def parse_packed_response(text, count):
+    """解析合并请求的输出，返回 count 个字符串的列表；不是等长的JSON数组时返回None"""
+    text = CODE_FENCE_PATTERN.sub("", THINK_BLOCK_PATTERN.sub("", text).strip())
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != count:
+        return None
+    if not all(isinstance(item, (str, int, float)) and not isinstance(item, bool) for item in items):
+        return None
+    return [str(item) for item in items]
+
+
+def build_reference_content(row, ref_columns):
+    """将一行中的引用列拼接为引用内容"""
+    return "\n".join([f"{col}: {row[col]}" for col in ref_columns])
+
+
+def build_reference_contents(df, ref_columns, rows=None):
+    """按列一次性拼接多行的引用内容，返回与 rows 顺序一致的列表
+
+    逐列取出Python值再拼接，避免对每行做 df.iloc 索引。
+    """
+    positions = list(rows) if rows is not None else list(range(len(df)))
+    if not ref_columns:
+        # 模板只使用列占位符时没有引用列
+        return [""] * len(positions)
+    columns = [[f"{col}: {value}" for value in df[col].iloc[positions].tolist()] for col in ref_columns]
+    return ["\n".join(parts) for parts in zip(*columns)]
+
+
+# 表示服务端过载或限流的HTTP状态码
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+class AIRequestError(Exception):
+    """一次AI请求失败，记录HTTP状态码、是否超时或连接失败，供并发控制和重试策略判断"""
+    def __init__(self, message, status_code=None, timeout=False, connection_error=False,
+                 retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.timeout = timeout
+        self.connection_error = connection_error
+        self.retry_after = retry_after  # 服务端通过Retry-After给出的等待秒数
+        self.attempts = 1
+        self.redistribute = False  # 失败的接口已被移除，可以立即改发到其他接口
+
+    def is_overload(self):
+        """是否为限流、服务繁忙或超时"""
+        return self.timeout or self.status_code in OVERLOAD_STATUS_CODES
+
+    def status_label(self):
+        """用于错误列表显示的状态"""
+        if self.timeout:
+            return "超时"
+        if self.status_code is not None:
+            return str(self.status_code)
+        if self.connection_error:
+            return "连接失败"
+        return "错误"
+
+    @classmethod
+    def from_response(cls, response):
+        """根据非200的HTTP响应(requests或httpx)创建异常"""
+        return cls(f"API返回状态码 {response.status_code}", response.status_code,
+                   retry_after=parse_retry_after(response.headers))
+
+    @classmethod
+    def from_openai_error(cls, error):
+        """把OpenAI SDK抛出的异常转换为AIRequestError"""
+        import openai
+        if isinstance(error, openai.APITimeoutError):
+            return cls(str(error), timeout=True)
+        if isinstance(error, openai.APIConnectionError):
+            return cls(str(error), connection_error=True)
+        response = getattr(error, "response", None)
+        retry_after = parse_retry_after(response.headers) if response is not None else None
+        return cls(str(error), getattr(error, "status_code", None), retry_after=retry_after)
+
+    @classmethod
+    def from_exception(cls, error):
+        """把处理一行时的意外异常转换为AIRequestError，使其只记为该行失败而不终止整个任务"""
+        if isinstance(error, cls):
+            return error
+        return cls(f"{type(error).__name__}: {error}")
+
+
+def parse_retry_after(headers):
+    """解析Retry-After响应头（只支持秒数形式）"""
+    value = headers.get("retry-after") if headers is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RetryPolicy:
+    """按错误类别分别计数的重试策略
+
+    超时、5xx(含连接失败)和429各有独立的重试次数，重试间隔按指数退避并加入随机抖动；
+    429响应带有Retry-After时至少等待服务端要求的时间。其他错误(如400、401)不重试。
+    """
+    def __init__(self, timeout_retries=2, server_error_retries=3, rate_limit_retries=5,
+                 base_delay=1.0, max_delay=60.0):
+        self.budgets = {
+            "timeout": timeout_retries,
+            "server_error": server_error_retries,
+            "rate_limit": rate_limit_retries,
+        }
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def category(error):
+        """判断错误所属的重试类别，不可重试时返回None"""
+        if error.timeout:
+            return "timeout"
+        if error.status_code == 429:
+            return "rate_limit"
+        if error.connection_error or (error.status_code is not None and error.status_code >= 500):
+            return "server_error"
+        return None
+
+    def next_delay(self, error, attempts):
+        """登记一次失败并返回下次重试前的等待秒数；不再重试时返回None
+
+        attempts 是调用方为单行维护的 {类别: 已重试次数} 字典。
+        """
+        category = self.category(error)
+        if category is None or attempts.get(category, 0) >= self.budgets[category]:
+            return None
+        attempts[category] = attempts.get(category, 0) + 1
+
+        # 指数退避 + 抖动：在 [delay/2, delay] 内随机取值，避免所有线程同时重试
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts[category] - 1)))
+        delay = random.uniform(delay / 2, delay)
+        if error.retry_after:
+            delay = max(delay, min(error.retry_after, self.max_delay))
+        return delay
+
+
+def percentile(values, fraction):
+    """计算列表的分位数（最近秩法）"""
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+class AdaptiveConcurrency:
+    """AIMD自适应并发控制器
+
+    每完成约一个并发窗口的请求，计算该窗口的p95延迟：延迟没有明显高于基线时并发
+    加1（加性增）；延迟明显升高时略微降低；遇到429/503或超时立即减半（乘性减）。
+    多线程引擎和异步引擎在每次请求前申请名额，请求结束后回报延迟，
+    因此同一任务配置在单卡Ollama和OpenAI API上都能自动找到合适的并发。
+    """
+    def __init__(self, max_limit, min_limit=1, initial_limit=None,
+                 latency_tolerance=1.5, decrease_factor=0.5, min_window=5):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        if initial_limit is None:
+            initial_limit = min(self.max_limit, max(self.min_limit, 2))
+        self._limit = float(initial_limit)
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.min_window = min_window
+
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # 等待名额的协程：(事件循环, asyncio.Event)
+        self._latencies = []  # 当前窗口内成功请求的延迟
+        self._baseline_p95 = None
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        """当前允许的并发数"""
+        return int(self._limit)
+
+    def try_acquire(self):
+        """尝试占用一个并发名额，不阻塞"""
+        with self._cond:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """占用一个并发名额，名额不足时阻塞等待"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """异步引擎使用的申请方法，名额不足时挂起直到 release 唤醒"""
+        while True:
+            with self._cond:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                waiter = (asyncio.get_running_loop(), asyncio.Event())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            finally:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def release(self, latency, overloaded=False):
+        """归还名额并根据本次请求的结果调整并发数"""
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self._decrease(self.decrease_factor)
+            else:
+                self._record_latency(latency)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        # release 可能在工作线程中调用，通过 call_soon_threadsafe 唤醒事件循环中的等待者
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _record_latency(self, latency):
+        """记录成功请求的延迟，窗口满时决定增减"""
+        self._latencies.append(latency)
+        if len(self._latencies) < max(self.limit, self.min_window):
+            return
+
+        p95 = percentile(self._latencies, 0.95)
+        self._latencies = []
+        if self._baseline_p95 is None:
+            self._baseline_p95 = p95
+
+        if p95 <= self._baseline_p95 * self.latency_tolerance:
+            # 延迟稳定：加性增，并让基线缓慢跟随
+            self._limit = min(self.max_limit, self._limit + 1)
+            self._baseline_p95 = 0.9 * self._baseline_p95 + 0.1 * p95
+        else:
+            # 延迟明显升高(如Ollama开始排队)：小幅回退
+            self._decrease(0.9)
+
+    def _decrease(self, factor):
+        """乘性减；冷却期内只减一次，避免同一波错误把并发压到最低"""
+        now = time.time()
+        cooldown = max(1.0, self._baseline_p95 or 0.0)
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, min(self._limit - 1, self._limit * factor))
+        self._latencies = []
+
+
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """粗略估算文本的令牌数：中文字符约1个令牌，其他字符约4个一个令牌"""
+    cjk_count = len(CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count) / 4.0
+
+
+def openai_content(response):
+    """取出OpenAI响应的文本；内容为空(拒绝回答、只有工具调用等)时抛出AIRequestError"""
+    message = response.choices[0].message
+    if not message.content:
+        refusal = getattr(message, "refusal", None)
+        raise AIRequestError(f"模型拒绝回答: {refusal}" if refusal else "模型返回了空内容")
+    return message.content
+
+
+def openai_usage(response):
+    """从OpenAI响应中取出(输入令牌数, 输出令牌数)，没有usage时返回None"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0
+
+
+def ollama_usage(result):
+    """从Ollama响应中取出(输入令牌数, 输出令牌数)，没有统计字段时返回None"""
+    if 'prompt_eval_count' not in result and 'eval_count' not in result:
+        return None
+    return result.get('prompt_eval_count', 0), result.get('eval_count', 0)
+
+
+class RateLimiter:
+    """按每分钟请求数(RPM)和每分钟令牌数(TPM)限速的双令牌桶
+
+    所有工作线程/协程共用一个实例。每次请求先按估算的令牌数预扣额度，
+    额度不足时计算需要等待的时间；响应返回后用usage中的真实令牌数修正余额，
+    并逐步校准估算系数，使任务能贴着账户限额运行而不被限流。
+    参数为0或None表示不限制该项。
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, expected_output_tokens=200):
+        self.requests_per_minute = requests_per_minute or 0
+        self.tokens_per_minute = tokens_per_minute or 0
+        self._lock = threading.Lock()
+        self._last_refill = time.time()
+        # 令牌桶初始为满
+        self._request_budget = float(self.requests_per_minute)
+        self._token_budget = float(self.tokens_per_minute)
+        # 估算系数：真实输入令牌数/粗略估算值，以及平均输出令牌数，均随usage更新
+        self._prompt_ratio = 1.0
+        self._output_tokens = float(expected_output_tokens)
+
+    def _refill(self):
+        """按流逝时间补充额度，不超过一分钟的上限"""
+        now = time.time()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_budget = min(self.requests_per_minute,
+                                       self._request_budget + elapsed * self.requests_per_minute / 60.0)
+        if self.tokens_per_minute:
+            self._token_budget = min(self.tokens_per_minute,
+                                     self._token_budget + elapsed * self.tokens_per_minute / 60.0)
+
+    def reserve(self, text):
+        """预扣一次请求的额度，返回(预约信息, 需要等待的秒数)"""
+        heuristic = estimate_tokens(text)
+        with self._lock:
+            self._refill()
+            estimated = heuristic * self._prompt_ratio + self._output_tokens
+            wait = 0.0
+            if self.requests_per_minute:
+                self._request_budget -= 1
+                if self._request_budget < 0:
+                    wait = max(wait, -self._request_budget * 60.0 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # 单个请求的估算不超过桶容量，否则永远等不到
+                estimated = min(estimated, self.tokens_per_minute)
+                self._token_budget -= estimated
+                if self._token_budget < 0:
+                    wait = max(wait, -self._token_budget * 60.0 / self.tokens_per_minute)
+        return (estimated, heuristic), wait
+
+    def acquire(self, text):
+        """预扣额度并在需要时阻塞等待，返回预约信息"""
+        reservation, wait = self.reserve(text)
+        if wait > 0:
+            time.sleep(wait)
+        return reservation
+
+    async def acquire_async(self, text):
+        """异步引擎使用的申请方法"""
+        reservation, wait = self.reserve(text)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return reservation
+
+    def record_usage(self, reservation, prompt_tokens, completion_tokens):
+        """用响应中的真实令牌数修正余额和估算系数"""
+        estimated, heuristic = reservation
+        with self._lock:
+            if self.tokens_per_minute:
+                self._token_budget -= (prompt_tokens + completion_tokens) - estimated
+            if heuristic > 0 and prompt_tokens:
+                self._prompt_ratio = 0.8 * self._prompt_ratio + 0.2 * (prompt_tokens / heuristic)
+            self._output_tokens = 0.8 * self._output_tokens + 0.2 * completion_tokens
+
+
+def parse_endpoints(text):
+    """把逗号、分号或空白分隔的接口地址解析为列表，去掉末尾的/和重复地址"""
+    urls = []
+    for part in re.split(r'[\s,;]+', text or ""):
+        url = part.rstrip('/')
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+
+class Endpoint:
+    """一个接口地址的负载、吞吐和健康状态，只在 EndpointPool 的锁内修改"""
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0  # 在途请求数
+        self.assigned = 0  # 累计分配的请求数
+        self.completed = 0  # 成功的请求数
+        self.failed = 0  # 失败的请求数
+        self.consecutive_failures = 0  # 连续超时或连接失败次数
+        self.healthy = True
+        self.eject_reason = ""
+        self.meter = ProgressMeter(0)  # 只用于计算最近的吞吐
+
+
+class EndpointPool:
+    """多个Ollama或OpenAI兼容接口之间的负载均衡
+
+    每次请求选择在途请求最少的可用接口(相同时选累计分配较少的)，处理得快的接口在途
+    请求释放得快，自然分到更多的行。连续 max_failures 次超时或连接失败的接口被移除，
+    这些请求和之后的请求改发到其余接口。后台线程每 health_interval 秒检查一次所有接口：
+    无响应的接口被移除，恢复响应的接口重新加入。所有接口都被移除时仍在全部接口中按
+    最少在途选择，由重试策略决定是否继续。首次分配请求时先同步检查一次。
+    """
+    def __init__(self, urls, api_type, api_key=None, max_failures=EJECT_AFTER_FAILURES,
+                 health_interval=HEALTH_CHECK_INTERVAL, health_timeout=HEALTH_CHECK_TIMEOUT):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.api_type = api_type
+        self.api_key = api_key
+        self.max_failures = max(1, max_failures)
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """检查一次所有接口并启动后台健康检查线程，重复调用无效"""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            self.check_health()
+            thread = threading.Thread(target=self._health_loop)
+            thread.daemon = True  # 设置为守护线程
+            thread.start()
+
+    def stop(self):
+        """停止后台健康检查"""
+        self._stop_event.set()
+
+    def _health_loop(self):
+        """后台健康检查线程"""
+        while not self._stop_event.wait(self.health_interval):
+            self.check_health()
+
+    def probe(self, endpoint):
+        """检查一个接口是否响应，返回错误信息，正常时返回None
+
+        Ollama请求 /api/version，OpenAI兼容接口请求 /models；只要服务端返回了
+        5xx以外的响应就视为可用(认证或路径问题会在正式请求中报告)。
+        """
+        if self.api_type == "ollama":
+            url, headers = f"{endpoint.url}/api/version", {}
+        else:
+            url = f"{endpoint.url}/models"
+            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        try:
+            response = requests.get(url, headers=headers, timeout=self.health_timeout)
+        except requests.Timeout:
+            return "健康检查超时"
+        except requests.RequestException:
+            return "健康检查连接失败"
+        if response.status_code >= 500:
+            return f"健康检查返回状态码 {response.status_code}"
+        return None
+
+    def check_health(self):
+        """同时检查所有接口，移除无响应的接口，恢复已响应的接口"""
+        results = {}
+
+        def run(endpoint):
+            results[endpoint.url] = self.probe(endpoint)
+
+        threads = [threading.Thread(target=run, args=(endpoint,)) for endpoint in self.endpoints]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self._lock:
+            for endpoint in self.endpoints:
+                error = results.get(endpoint.url)
+                if error is None:
+                    endpoint.healthy = True
+                    endpoint.eject_reason = ""
+                    endpoint.consecutive_failures = 0
+                else:
+                    endpoint.healthy = False
+                    endpoint.eject_reason = error
+
+    def eject(self, url, reason):
+        """移除指定接口，直到健康检查发现它恢复"""
+        with self._lock:
+            for endpoint in self.endpoints:
+                if endpoint.url == url:
+                    endpoint.healthy = False
+                    endpoint.eject_reason = reason
+
+    def healthy_urls(self):
+        """当前可用的接口地址"""
+        with self._lock:
+            return [endpoint.url for endpoint in self.endpoints if endpoint.healthy]
+
+    def acquire(self):
+        """为一次请求选择接口并登记在途，请求结束后必须调用 release
+
+        尚未启动时在这里启动(会同步做一次健康检查)；异步任务应在事件循环外先调用 start。
+        """
+        self.start()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.assigned))
+            endpoint.outstanding += 1
+            endpoint.assigned += 1
+            return endpoint
+
+    def release(self, endpoint, error=None):
+        """登记请求结束；超时或连接失败的请求所在接口被移除且还有其他可用接口时，
+        把 error.redistribute 设为True"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.completed += 1
+                endpoint.consecutive_failures = 0
+                endpoint.meter.update(endpoint.completed)
+                return
+            endpoint.failed += 1
+            if not (error.timeout or error.connection_error):
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.healthy and endpoint.consecutive_failures >= self.max_failures:
+                endpoint.healthy = False
+                endpoint.eject_reason = error.status_label()
+            if not endpoint.healthy:
+                error.redistribute = any(e.healthy for e in self.endpoints)
+
+    def stats_lines(self):
+        """每个接口一行的吞吐和状态，用于进度显示"""
+        lines = []
+        with self._lock:
+            for endpoint in self.endpoints:
+                endpoint.meter.update(endpoint.completed)
+                line = (f"{endpoint.url}: 完成 {endpoint.completed} 次 "
+                        f"({endpoint.meter.rate():.1f} 次/秒，在途 {endpoint.outstanding})")
+                if endpoint.failed:
+                    line += f"，失败 {endpoint.failed} 次"
+                if not endpoint.healthy:
+                    line += f"，已移除({endpoint.eject_reason})"
+                lines.append(line)
+        return lines
+
+
+class GenerationEngine:
+    """一次生成任务的AI调用配置
+
+    在任务开始时从界面控件或命令行参数取值，之后工作线程只读取这些属性，
+    不再访问任何Tk控件。同一任务的所有工作线程共用一个OpenAI客户端和一个
+    保持长连接的requests会话，避免每行都重新建立TCP/TLS连接。
+
+    ollama_url(Ollama)或 base_url(OpenAI兼容接口)可以是逗号分隔的多个地址，
+    此时请求经 EndpointPool 在各地址之间负载均衡，每个地址各用一个客户端。
+    """
+    def __init__(self, api_type, model, prompt_template, api_key=None,
+                 ollama_url=DEFAULT_OLLAMA_URL, temperature=0.7, pool_size=4,
+                 concurrency=None, rate_limiter=None, retry_policy=None, cache=None,
+                 cleaning_steps=None, base_url=None, ollama_options=None, keep_alive=None):
+        self.api_type = api_type
+        self.model = model
+        self.prompt_template = prompt_template
+        self.template = compile_template(prompt_template)
+        self.cleaner = OutputCleaner(prompt_template, cleaning_steps)
+        self.api_key = api_key
+        self.base_url = base_url  # OpenAI兼容接口地址，None表示使用官方接口
+        self.ollama_url = ollama_url or DEFAULT_OLLAMA_URL
+        urls = parse_endpoints(self.ollama_url if api_type == "ollama" else base_url)
+        if urls:
+            # 单独使用时(预览、批处理、只有一个地址)使用第一个地址
+            if api_type == "ollama":
+                self.ollama_url = urls[0]
+            else:
+                self.base_url = urls[0]
+        self.endpoints = EndpointPool(urls, api_type, api_key) if len(urls) > 1 else None
+        self.ollama_options = dict(ollama_options or {})  # 每次Ollama请求附带的options
+        self.keep_alive = keep_alive  # 模型在Ollama中保持加载的时间，None表示使用服务端默认值
+        # 模板参数中的temperature同样用于OpenAI接口
+        self.temperature = self.ollama_options.get("temperature", temperature)
+        self.pool_size = max(1, pool_size)
+        self.concurrency = concurrency  # 可选的AdaptiveConcurrency控制器
+        self.rate_limiter = rate_limiter  # 可选的RateLimiter限速器
+        self.retry_policy = retry_policy  # 可选的RetryPolicy，None表示不重试
+        self.cache = cache  # 可选的ResponseCache，None表示不使用缓存
+
+        # 连接池在首次使用时创建
+        self._client_lock = threading.Lock()
+        self._openai_clients = {}  # {接口地址: OpenAI客户端}
+        self._session = None
+        self._async_openai_clients = {}
+        self._async_http_client = None
+
+    def get_openai_client(self, base_url=None):
+        """获取任务共享的OpenAI客户端（线程安全），base_url 默认为第一个接口地址"""
+        base_url = base_url or self.base_url
+        with self._client_lock:
+            if base_url not in self._openai_clients:
+                # 关闭SDK自带的重试，统一由RetryPolicy按类别控制
+                self._openai_clients[base_url] = OpenAI(api_key=self.api_key, base_url=base_url,
+                                                        max_retries=0)
+            return self._openai_clients[base_url]
+
+    def get_session(self):
+        """获取任务共享的HTTP会话，连接池大小与工作线程数一致"""
+        with self._client_lock:
+            if self._session is None:
+                session = requests.Session()
+                hosts = len(self.endpoints.endpoints) if self.endpoints is not None else 1
+                adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+
+    def close(self):
+        """关闭任务持有的连接"""
+        with self._client_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            for client in self._openai_clients.values():
+                client.close()
+            self._openai_clients = {}
+        if self.endpoints is not None:
+            self.endpoints.stop()
+
+    def render_prompt(self, reference_text, row_values=None):
+        """用引用内容和本行的列值({列名}占位符)渲染提示词模板"""
+        variables = dict(row_values) if row_values else {}
+        variables["引用内容"] = reference_text
+        return self.template.render(variables)
+
+    def render_prompts(self, references, column_values=None):
+        """批量渲染提示词
+
+        column_values 为 {列名: 与 references 对应的值列表}，引用内容和列值都相同的行只渲染一次。
+        """
+        columns = list(column_values) if column_values else []
+        value_lists = [column_values[col] for col in columns]
+        rendered = {}
+        prompts = []
+        for i, reference in enumerate(references):
+            values = tuple(template_value(column[i]) for column in value_lists)
+            key = (reference,) + values
+            if key not in rendered:
+                rendered[key] = self.render_prompt(reference, dict(zip(columns, values)))
+            prompts.append(rendered[key])
+        return prompts
+
+    def clean_output(self, text):
+        """按任务开始时配置的清理流水线清理AI输出"""
+        return self.cleaner.clean(text)
+
+    def sampling_params(self):
+        """实际发送且影响输出结果的采样参数，参与缓存键计算
+
+        OpenAI请求带 temperature；Ollama请求不发送 temperature，只发送 options(其中可设置temperature)。
+        """
+        if self.api_type == "ollama":
+            return {"options": self.ollama_options} if self.ollama_options else {}
+        return {"temperature": self.temperature}
+
+    def cache_key(self, prompt, system_message, packed=False):
+        """计算本次请求的缓存键，合并请求中各行的结果单独缓存，与逐行请求的结果互不混用"""
+        params = self.sampling_params()
+        if packed:
+            params["packed"] = True
+        return make_cache_key(self.api_type, self.model, system_message, prompt, params)
+
+    def build_messages(self, prompt, system_message):
+        """构建chat接口的消息列表"""
+        return [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ]
+
+    def ollama_extra_fields(self):
+        """Ollama请求体中的keep_alive和options字段"""
+        fields = {}
+        if self.keep_alive is not None:
+            fields["keep_alive"] = self.keep_alive
+        if self.ollama_options:
+            fields["options"] = self.ollama_options
+        return fields
+
+    def ollama_chat_request(self, prompt, system_message, base_url=None):
+        """构建Ollama chat API的请求地址和请求体，base_url 默认为第一个接口地址"""
+        url = f"{(base_url or self.ollama_url).rstrip('/')}/api/chat"
+        data = {
+            "model": self.model,
+            "messages": self.build_messages(prompt, system_message),
+            "stream": False
+        }
+        data.update(self.ollama_extra_fields())
+        return url, data
+
+    def ollama_generate_request(self, prompt, system_message, base_url=None):
+        """构建Ollama generate API的请求地址和请求体（chat API不可用时的回退）"""
+        url = f"{(base_url or self.ollama_url).rstrip('/')}/api/generate"
+        data = {
+            "model": self.model,
+            "prompt": f"{system_message}\n\n{prompt}",
+            "stream": False
+        }
+        data.update(self.ollama_extra_fields())
+        return url, data
+
+    def warm_up(self):
+        """预热模型，返回用时(秒)，失败时抛出AIRequestError
+
+        Ollama收到不含提示词的generate请求时只把模型加载到内存，带上与正式请求相同的
+        options(num_ctx不同会导致重新加载)和keep_alive。OpenAI接口无需预热，返回None。
+        配置了多个接口时各接口同时预热，预热失败的接口被移除，全部失败时才抛出异常。
+        """
+        if self.api_type != "ollama":
+            return None
+        if self.endpoints is None:
+            return self.warm_up_url(self.ollama_url)
+
+        self.endpoints.start()
+        start_time = time.time()
+        errors = {}
+
+        def run(url):
+            try:
+                self.warm_up_url(url)
+            except AIRequestError as e:
+                errors[url] = e
+                self.endpoints.eject(url, f"预热失败: {e.status_label()}")
+
+        urls = self.endpoints.healthy_urls()
+        threads = [threading.Thread(target=run, args=(url,)) for url in urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not urls:
+            raise AIRequestError("所有接口的健康检查都失败", connection_error=True)
+        if len(errors) == len(urls):
+            raise next(iter(errors.values()))
+        return time.time() - start_time
+
+    def warm_up_url(self, base_url):
+        """在一个Ollama接口上预热模型，返回用时(秒)"""
+        url = f"{base_url.rstrip('/')}/api/generate"
+        data = {"model": self.model}
+        data.update(self.ollama_extra_fields())
+        start_time = time.time()
+        try:
+            response = self.get_session().post(url, json=data, timeout=WARM_UP_TIMEOUT)
+        except requests.Timeout as e:
+            raise AIRequestError(str(e), timeout=True)
+        except requests.RequestException as e:
+            raise AIRequestError(str(e), connection_error=True)
+        if response.status_code != 200:
+            raise AIRequestError.from_response(response)
+        return time.time() - start_time
+
+    def parse_ollama_response(self, result):
+        """从Ollama响应中取出原始生成内容"""
+        if 'message' in result:
+            return result['message']['content']
+        return result['response']
+
+    def generate(self, reference_text, row_values=None):
+        """使用AI生成内容，按重试策略重试后仍失败时抛出AIRequestError"""
+        return self.generate_prompt(self.render_prompt(reference_text, row_values))
+
+    def generate_prompt(self, prompt):
+        """为已渲染的提示词生成内容
+
+        启用缓存时先按缓存键查找，命中则不再请求模型；缓存中保存清理前的原始输出。
+        """
+        system_message = build_system_message(prompt)
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(prompt, system_message)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return self.clean_output(cached)
+
+        content = self.request_with_retry(prompt, system_message)
+        if key is not None:
+            self.cache.put(key, content)
+        return self.clean_output(content)
+
+    def generate_packed(self, prompts):
+        """把多行的提示词合并为一次请求，返回与 prompts 对应的清理后内容列表
+
+        各行先单独查缓存，只合并未命中的行。未命中的行系统消息不同，或模型返回的不是等长的
+        JSON数组时返回None，由调用方改为逐行请求；请求按重试策略重试后仍失败时抛出AIRequestError。
+        """
+        contents, keys, pending = self.lookup_packed(prompts)
+        if pending:
+            system_message = packed_system_message([prompts[i] for i in pending])
+            if system_message is None:
+                return None
+            packed_prompt = build_packed_prompt([prompts[i] for i in pending])
+            content = self.request_with_retry(packed_prompt, system_message)
+            if not self.store_packed(content, contents, keys, pending):
+                return None
+        return [self.clean_output(content) for content in contents]
+
+    def lookup_packed(self, prompts):
+        """按行查询合并请求的缓存，返回 (原始内容列表, 缓存键列表, 未命中的位置列表)"""
+        contents = [None] * len(prompts)
+        keys = [None] * len(prompts)
+        pending = []
+        for i, prompt in enumerate(prompts):
+            if self.cache is not None:
+                system_message = build_system_message(prompt)
+                keys[i] = self.cache_key(prompt, system_message, packed=True)
+                # 上次合并结果无法解析而改为逐行请求的行，逐行请求的结果同样可以复用
+                contents[i] = self.cache.get_first([keys[i], self.cache_key(prompt, system_message)])
+            if contents[i] is None:
+                pending.append(i)
+        return contents, keys, pending
+
+    def store_packed(self, content, contents, keys, pending):
+        """解析合并请求的输出并按行写入 contents 和缓存，解析失败时返回False"""
+        items = parse_packed_response(content, len(pending))
+        if items is None:
+            return False
+        for i, item in zip(pending, items):
+            contents[i] = item
+            if keys[i] is not None:
+                self.cache.put(keys[i], item)
+        return True
+
+    def request_with_retry(self, prompt, system_message):
+        """发送生成请求并按重试策略重试，返回未清理的输出，最终失败时抛出AIRequestError"""
+        attempts = {}
+        redistributed = 0
+        while True:
+            try:
+                return self.request_completion(prompt, system_message)
+            except AIRequestError as e:
+                if self.should_redistribute(e, redistributed):
+                    # 失败的接口已被移除，立即改发到其他接口，不占用重试次数
+                    redistributed += 1
+                    continue
+                delay = self.retry_policy.next_delay(e, attempts) if self.retry_policy else None
+                if delay is None:
+                    e.attempts = sum(attempts.values()) + 1
+                    raise
+                time.sleep(delay)
+
+    def should_redistribute(self, error, redistributed):
+        """失败的请求是否改发到其他接口；每行最多改发的次数与接口数相同，避免接口反复恢复又失败时无限重发"""
+        return error.redistribute and redistributed < len(self.endpoints.endpoints)
+
+    def request_completion(self, prompt, system_message):
+        """发送一次生成请求，返回未清理的输出，失败时抛出AIRequestError
+
+        设置了限速器时先按请求数和估算的令牌数排队，并在拿到响应后用usage修正；
+        启用自适应并发时再向控制器申请并发名额，结束后回报延迟和是否过载。
+        配置了多个接口时选择在途请求最少的接口，结束后登记结果。
+        """
+        if self.api_type not in ("openai", "ollama"):
+            raise AIRequestError("未知的API类型")
+
+        reservation = None
+        if self.rate_limiter is not None:
+            reservation = self.rate_limiter.acquire(system_message + prompt)
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        endpoint = self.endpoints.acquire() if self.endpoints is not None else None
+        base_url = endpoint.url if endpoint is not None else None
+        start_time = time.time()
+        overloaded = False
+        error = None
+        try:
+            if self.api_type == "openai":
+                content, usage = self._request_openai(prompt, system_message, base_url)
+            else:
+                content, usage = self._request_ollama(prompt, system_message, base_url)
+            if reservation is not None and usage is not None:
+                self.rate_limiter.record_usage(reservation, *usage)
+            return content
+        except AIRequestError as e:
+            overloaded = e.is_overload()
+            error = e
+            raise
+        finally:
+            if endpoint is not None:
+                self.endpoints.release(endpoint, error)
+            if self.concurrency is not None:
+                self.concurrency.release(time.time() - start_time, overloaded)
+
+    def _request_openai(self, prompt, system_message, base_url=None):
+        """调用OpenAI Chat Completions接口"""
+        client = self.get_openai_client(base_url)
+        try:
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=self.build_messages(prompt, system_message),
+                temperature=self.temperature,
+            )
+        except Exception as e:
+            raise AIRequestError.from_openai_error(e)
+        return openai_content(response), openai_usage(response)
+
+    def _request_ollama(self, prompt, system_message, base_url=None):
+        """调用Ollama接口，chat API失败时回退到generate API"""
+        session = self.get_session()
+
+        try:
+            # 尝试使用chat API
+            url, data = self.ollama_chat_request(prompt, system_message, base_url)
+            response = session.post(url, json=data, timeout=120)
+            if response.status_code == 200:
+                result = response.json()
+                return self.parse_ollama_response(result), ollama_usage(result)
+            if response.status_code in OVERLOAD_STATUS_CODES:
+                raise AIRequestError.from_response(response)
+
+            # 如果chat API失败，尝试使用generate API
+            url, data = self.ollama_generate_request(prompt, system_message, base_url)
+            response = session.post(url, json=data, timeout=120)
+            if response.status_code == 200:
+                result = response.json()
+                return self.parse_ollama_response(result), ollama_usage(result)
+            raise AIRequestError.from_response(response)
+        except requests.Timeout as e:
+            raise AIRequestError(str(e), timeout=True)
+        except requests.ConnectionError as e:
+            raise AIRequestError(str(e), connection_error=True)
+        except AIRequestError:
+            raise
+        except Exception as e:
+            raise AIRequestError(str(e))
+
+    def stream(self, reference_text, row_values=None, on_text=None):
+        """流式生成一行内容(用于预览)，见 stream_prompt"""
+        return self.stream_prompt(self.render_prompt(reference_text, row_values), on_text)
+
+    def stream_prompt(self, prompt, on_text=None):
+        """流式生成：每收到一段文本调用 on_text(文本)，返回 (清理后的内容, 统计)
+
+        统计为 {"ttft": 首个令牌耗时, "elapsed": 总耗时, "tokens": 输出令牌数,
+        "tokens_per_sec": 首个令牌之后的生成速度, "cached": 是否命中缓存}。不重试，
+        失败时抛出AIRequestError。缓存命中时整段内容一次回调。
+        """
+        system_message = build_system_message(prompt)
+        key = None
+        start_time = time.time()
+        if self.cache is not None:
+            key = self.cache_key(prompt, system_message)
+            cached = self.cache.get(key)
+            if cached is not None:
+                if on_text is not None:
+                    on_text(cached)
+                stats = {"ttft": time.time() - start_time, "elapsed": time.time() - start_time,
+                         "tokens": None, "tokens_per_sec": None, "cached": True}
+                return self.clean_output(cached), stats
+
+        if self.api_type not in ("openai", "ollama"):
+            raise AIRequestError("未知的API类型")
+        endpoint = self.endpoints.acquire() if self.endpoints is not None else None
+        base_url = endpoint.url if endpoint is not None else None
+        if self.api_type == "openai":
+            chunks = self._stream_openai(prompt, system_message, base_url)
+        else:
+            chunks = self._stream_ollama(prompt, system_message, base_url)
+
+        parts = []
+        first_token_time = None
+        chunk_count = 0
+        usage = None
+        error = None
+        try:
+            for text, chunk_usage in chunks:
+                if chunk_usage is not None:
+                    usage = chunk_usage
+                if not text:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time()
+                chunk_count += 1
+                parts.append(text)
+                if on_text is not None:
+                    on_text(text)
+        except AIRequestError as e:
+            error = e
+            raise
+        finally:
+            if endpoint is not None:
+                self.endpoints.release(endpoint, error)
+        end_time = time.time()
+
+        content = "".join(parts)
+        # 服务没有返回usage时按收到的文本块数估计令牌数(流式接口通常每块一个令牌)
+        tokens = usage[1] if usage is not None else chunk_count
+        decode_time = end_time - first_token_time if first_token_time is not None else 0
+        stats = {
+            "ttft": first_token_time - start_time if first_token_time is not None else None,
+            "elapsed": end_time - start_time,
+            "tokens": tokens,
+            # 首个令牌之后的时间内生成了其余的令牌
+            "tokens_per_sec": (tokens - 1) / decode_time if decode_time > 0 and tokens > 1 else None,
+            "cached": False,
+        }
+        if key is not None:
+            self.cache.put(key, content)
+        return self.clean_output(content), stats
+
+    def _stream_openai(self, prompt, system_message, base_url=None):
+        """流式调用OpenAI Chat Completions接口，逐块产生 (文本, usage或None)"""
+        client = self.get_openai_client(base_url)
+        try:
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=self.build_messages(prompt, system_message),
+                temperature=self.temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in response:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                yield text or "", openai_usage(chunk)
+        except Exception as e:
+            raise AIRequestError.from_openai_error(e)
+
+    def _stream_ollama(self, prompt, system_message, base_url=None):
+        """流式调用Ollama接口，逐块产生 (文本, usage或None)；chat API失败时回退到generate API"""
+        session = self.get_session()
+        try:
+            url, data = self.ollama_chat_request(prompt, system_message, base_url)
+            data["stream"] = True
+            response = session.post(url, json=data, timeout=120, stream=True)
+            if response.status_code != 200:
+                response.close()
+                if response.status_code in OVERLOAD_STATUS_CODES:
+                    raise AIRequestError.from_response(response)
+                url, data = self.ollama_generate_request(prompt, system_message, base_url)
+                data["stream"] = True
+                response = session.post(url, json=data, timeout=120, stream=True)
+                if response.status_code != 200:
+                    response.close()
+                    raise AIRequestError.from_response(response)
+
+            # Ollama每行返回一个JSON对象，最后一行 done 为true并带有令牌统计
+            with response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    if result.get("error"):
+                        raise AIRequestError(result["error"])
+                    text = result.get("message", {}).get("content") or result.get("response") or ""
+                    yield text, ollama_usage(result) if result.get("done") else None
+        except requests.Timeout as e:
+            raise AIRequestError(str(e), timeout=True)
+        except requests.ConnectionError as e:
+            raise AIRequestError(str(e), connection_error=True)
+        except AIRequestError:
+            raise
+        except Exception as e:
+            raise AIRequestError(str(e))
+
+    # 以下是asyncio引擎使用的异步接口，异步客户端只在事件循环线程中创建和使用
+
+    def get_async_openai_client(self, base_url=None):
+        """获取任务共享的异步OpenAI客户端，base_url 默认为第一个接口地址"""
+        base_url = base_url or self.base_url
+        if base_url not in self._async_openai_clients:
+            from openai import AsyncOpenAI
+            self._async_openai_clients[base_url] = AsyncOpenAI(api_key=self.api_key, base_url=base_url,
+                                                               max_retries=0)
+        return self._async_openai_clients[base_url]
+
+    def get_async_http_client(self):
+        """获取任务共享的异步HTTP客户端，连接数上限与最大并发请求数一致"""
+        if self._async_http_client is None:
+            # httpx是openai的依赖，仅在使用异步引擎时导入
+            import httpx
+            limits = httpx.Limits(max_connections=self.pool_size,
+                                  max_keepalive_connections=self.pool_size)
+            self._async_http_client = httpx.AsyncClient(limits=limits, timeout=120)
+        return self._async_http_client
+
+    async def aclose(self):
+        """关闭异步客户端"""
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+            self._async_http_client = None
+        for client in self._async_openai_clients.values():
+            await client.close()
+        self._async_openai_clients = {}
+
+    async def agenerate(self, reference_text, row_values=None):
+        """使用AI生成内容（异步版本），重试后仍失败时抛出AIRequestError"""
+        return await self.agenerate_prompt(self.render_prompt(reference_text, row_values))
+
+    async def agenerate_prompt(self, prompt):
+        """为已渲染的提示词生成内容（异步版本）"""
+        system_message = build_system_message(prompt)
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(prompt, system_message)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return self.clean_output(cached)
+
+        content = await self.arequest_with_retry(prompt, system_message)
+        if key is not None:
+            self.cache.put(key, content)
+        return self.clean_output(content)
+
+    async def agenerate_packed(self, prompts):
+        """把多行的提示词合并为一次请求（异步版本），见 generate_packed"""
+        contents, keys, pending = self.lookup_packed(prompts)
+        if pending:
+            system_message = packed_system_message([prompts[i] for i in pending])
+            if system_message is None:
+                return None
+            packed_prompt = build_packed_prompt([prompts[i] for i in pending])
+            content = await self.arequest_with_retry(packed_prompt, system_message)
+            if not self.store_packed(content, contents, keys, pending):
+                return None
+        return [self.clean_output(content) for content in contents]
+
+    async def arequest_with_retry(self, prompt, system_message):
+        """发送异步生成请求并按重试策略重试，返回未清理的输出"""
+        attempts = {}
+        redistributed = 0
+        while True:
+            try:
+                return await self.arequest_completion(prompt, system_message)
+            except AIRequestError as e:
+                if self.should_redistribute(e, redistributed):
+                    redistributed += 1
+                    continue
+                delay = self.retry_policy.next_delay(e, attempts) if self.retry_policy else None
+                if delay is None:
+                    e.attempts = sum(attempts.values()) + 1
+                    raise
+                await asyncio.sleep(delay)
+
+    async def arequest_completion(self, prompt, system_message):
+        """发送一次异步生成请求，返回未清理的输出，失败时抛出AIRequestError"""
+        if self.api_type not in ("openai", "ollama"):
+            raise AIRequestError("未知的API类型")
+
+        reservation = None
+        if self.rate_limiter is not None:
+            reservation = await self.rate_limiter.acquire_async(system_message + prompt)
+        if self.concurrency is not None:
+            await self.concurrency.acquire_async()
+        endpoint = self.endpoints.acquire() if self.endpoints is not None else None
+        base_url = endpoint.url if endpoint is not None else None
+        start_time = time.time()
+        overloaded = False
+        error = None
+        try:
+            if self.api_type == "openai":
+                content, usage = await self._arequest_openai(prompt, system_message, base_url)
+            else:
+                content, usage = await self._arequest_ollama(prompt, system_message, base_url)
+            if reservation is not None and usage is not None:
+                self.rate_limiter.record_usage(reservation, *usage)
+            return content
+        except AIRequestError as e:
+            overloaded = e.is_overload()
+            error = e
+            raise
+        finally:
+            if endpoint is not None:
+                self.endpoints.release(endpoint, error)
+            if self.concurrency is not None:
+                self.concurrency.release(time.time() - start_time, overloaded)
+
+    async def _arequest_openai(self, prompt, system_message, base_url=None):
+        """异步调用OpenAI Chat Completions接口"""
+        client = self.get_async_openai_client(base_url)
+        try:
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=self.build_messages(prompt, system_message),
+                temperature=self.temperature,
+            )
+        except Exception as e:
+            raise AIRequestError.from_openai_error(e)
+        return openai_content(response), openai_usage(response)
+
+    async def _arequest_ollama(self, prompt, system_message, base_url=None):
+        """异步调用Ollama接口，chat API失败时回退到generate API"""
+        import httpx
+        client = self.get_async_http_client()
+        try:
+            url, data = self.ollama_chat_request(prompt, system_message, base_url)
+            response = await client.post(url, json=data)
+            if response.status_code == 200:
+                result = response.json()
+                return self.parse_ollama_response(result), ollama_usage(result)
+            if response.status_code in OVERLOAD_STATUS_CODES:
+                raise AIRequestError.from_response(response)
+
+            url, data = self.ollama_generate_request(prompt, system_message, base_url)
+            response = await client.post(url, json=data)
+            if response.status_code == 200:
+                result = response.json()
+                return self.parse_ollama_response(result), ollama_usage(result)
+            raise AIRequestError.from_response(response)
+        except httpx.TimeoutException as e:
+            raise AIRequestError(str(e) or "请求超时", timeout=True)
+        except httpx.TransportError as e:
+            raise AIRequestError(str(e) or "连接失败", connection_error=True)
+        except AIRequestError:
+            raise
+        except Exception as e:
+            raise AIRequestError(str(e))
+
+
+def format_duration(seconds):
+    """把秒数格式化为显示文本，如 1小时02分、3分05秒、12秒；无法估计时返回 --"""
+    if seconds is None:
+        return "--"
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}小时{seconds % 3600 // 60:02d}分"
+    if seconds >= 60:
+        return f"{seconds // 60}分{seconds % 60:02d}秒"
+    return f"{seconds}秒"
+
+
+class ProgressMeter:
+    """处理速率和剩余时间估计
+
+    速率按最近 window 秒内的进度计算，缓存命中或并发调整引起的速率变化能较快反映到
+    剩余时间上；任务刚开始不足一个窗口时相当于全程平均。
+    """
+    def __init__(self, total, window=30.0):
+        self.total = total
+        self.window = window
+        self.processed = 0
+        self.start_time = time.monotonic()
+        self._samples = collections.deque([(self.start_time, 0)])
+
+    def update(self, processed):
+        """记录当前已处理的行数"""
+        now = time.monotonic()
+        self.processed = processed
+        self._samples.append((now, processed))
+        # 保留一个早于窗口起点的样本，使计算区间覆盖完整的窗口
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+
+    def elapsed(self):
+        """已用时间(秒)"""
+        return time.monotonic() - self.start_time
+
+    def rate(self):
+        """最近的处理速率(行/秒)"""
+        first_time, first_count = self._samples[0]
+        last_time, last_count = self._samples[-1]
+        if last_time <= first_time:
+            return 0.0
+        return (last_count - first_count) / (last_time - first_time)
+
+    def eta(self):
+        """预计剩余时间(秒)，速率为0时返回None"""
+        rate = self.rate()
+        if self.processed >= self.total:
+            return 0.0
+        if rate <= 0:
+            return None
+        return (self.total - self.processed) / rate
+
+    def status_text(self):
+        """进度显示文本"""
+        return (f"{self.processed}/{self.total} ({self.rate():.1f} 行/秒，"
+                f"剩余约 {format_duration(self.eta())})")
+
+
+class BaseGenerationJob:
+    """批量生成任务的公共部分
+
+    工作线程把 (行索引, 生成内容) 放入 result_queue，每处理完一行(无论成败)向
+    progress_queue 发送一个信号；重试后仍失败的行记录在 failures 中而不写入单元格，
+    任务照常完成，之后可以只重跑这些行。出现意外异常时放入 ("ERROR", 错误信息)。
+    rows 为要处理的行位置列表，默认处理全部行。
+
+    所有行的引用内容和提示词在创建任务时按列一次性构建(prompts 与 rows 一一对应，
+    可以查看或导出)，工作线程只负责请求。渲染后提示词相同的行只请求一次，结果分发给
+    所有相同的行；total_requests 和 completed_requests 统计去重后的请求数，与行数分开显示。
+    传入 checkpoint (CheckpointWriter) 时，每行结果同时追加到检查点文件。
+
+    pack_size 大于1时，每 pack_size 个去重后的请求合并为一次模型调用(见 generate_packed)，
+    适合输出很短的提取、分类类模板；模型返回的结果个数不对或无法解析时，这批改为逐行请求。
+    warm_up 为True时在第一个请求前预热模型(见 GenerationEngine.warm_up)，预热失败不影响任务。
+    """
+    def __init__(self, engine, df, ref_columns, rows=None, checkpoint=None, pack_size=1, warm_up=False):
+        self.engine = engine
+        self.pack_size = max(1, pack_size)
+        self.warm_up = warm_up
+        self._warm_up_lock = threading.Lock()
+        self._warm_up_done_message = ""  # 预热完成的提示，开始请求后清除
+        self.checkpoint = checkpoint
+        self.df = df
+        self.ref_columns = ref_columns
+        self.rows = list(rows) if rows is not None else list(range(len(df)))
+        self.total_rows = len(self.rows)
+        # 模板中的 {列名} 占位符直接取对应列的值
+        column_values = {col: df[col].iloc[self.rows].tolist()
+                         for col in template_columns(engine.prompt_template, df.columns)}
+        self.prompts = self.engine.render_prompts(build_reference_contents(df, ref_columns, self.rows),
+                                                  column_values)
+        self.groups = self.build_request_groups()
+        self.total_requests = len(self.groups)
+        self.completed_requests = 0
+        self.completed_rows = []  # 成功生成的行位置
+        self.status_message = ""  # 当前阶段的说明(如批处理状态)，供进度显示
+
+        self.result_queue = queue.Queue()
+        self.progress_queue = queue.Queue()
+        self.failures = []  # 失败行: {"row": 行位置, "index": 行索引, "status": 状态, "attempts": 尝试次数, "error": 错误信息}
+        self._failures_lock = threading.Lock()
+
+    def build_request_groups(self):
+        """按渲染后的提示词对行分组
+
+        返回 [(提示词, [(行位置, 行索引), ...]), ...]，按首次出现的顺序排列。
+        """
+        groups = {}
+        indexes = self.df.index[self.rows].tolist()
+        for position, index, prompt in zip(self.rows, indexes, self.prompts):
+            groups.setdefault(prompt, []).append((position, index))
+        return list(groups.items())
+
+    def prompts_dataframe(self):
+        """渲染后的提示词表，用于查看或导出"""
+        return pd.DataFrame({"行号": [position + 1 for position in self.rows], "提示词": self.prompts})
+
+    def record_result(self, index, content):
+        """记录一行的生成结果"""
+        self.result_queue.put((index, content))
+        self.progress_queue.put(1)  # 表示完成了一行，只发送一个信号
+
+    def record_failure(self, position, index, error):
+        """记录重试后仍失败的行"""
+        with self._failures_lock:
+            self.failures.append({
+                "row": position,
+                "index": index,
+                "status": error.status_label(),
+                "attempts": error.attempts,
+                "error": str(error),
+            })
+        self.progress_queue.put(1)
+
+    def record_group_result(self, members, content):
+        """把一个请求的结果分发给提示词相同的所有行"""
+        with self._failures_lock:
+            self.completed_requests += 1
+            self.completed_rows.extend(position for position, _ in members)
+        for position, index in members:
+            if self.checkpoint is not None:
+                self.checkpoint.write(position, content)
+            self.record_result(index, content)
+
+    def record_group_failure(self, members, error):
+        """提示词相同的所有行都记为失败"""
+        with self._failures_lock:
+            self.completed_requests += 1
+        for position, index in members:
+            self.record_failure(position, index, error)
+
+    def warm_up_model(self):
+        """需要时预热模型，只执行一次；其他工作线程在此等待预热完成"""
+        with self._warm_up_lock:
+            if not self.warm_up:
+                return
+            self.warm_up = False
+            self.status_message = "正在预热模型..."
+            try:
+                elapsed = self.engine.warm_up()
+            except AIRequestError as e:
+                self.status_message = f"模型预热失败，继续处理: {str(e)}"
+                return
+            self.status_message = f"模型预热完成，用时 {elapsed:.1f} 秒" if elapsed is not None else ""
+            self._warm_up_done_message = self.status_message
+
+    def request_started(self):
+        """开始发出请求后清除预热完成的提示，进度显示回到实际状态"""
+        if self._warm_up_done_message:
+            if self.status_message == self._warm_up_done_message:
+                self.status_message = ""
+            self._warm_up_done_message = ""
+
+    def iter_packs(self, groups):
+        """把请求按 pack_size 切分为合并批次，系统消息不同的请求不合并到同一批"""
+        if self.pack_size == 1:
+            for group in groups:
+                yield [group]
+            return
+        by_message = {}
+        for group in groups:
+            by_message.setdefault(build_system_message(group[0]), []).append(group)
+        for same_message in by_message.values():
+            for start in range(0, len(same_message), self.pack_size):
+                yield same_message[start:start + self.pack_size]
+
+    def record_pack_results(self, pack, contents):
+        """分发合并请求的结果，contents 与 pack 中的请求一一对应"""
+        for (_, members), content in zip(pack, contents):
+            self.record_group_result(members, content)
+
+    def record_pack_failure(self, pack, error):
+        """合并请求失败时这批的所有行都记为失败"""
+        for _, members in pack:
+            self.record_group_failure(members, error)
+
+
+class GenerationJob(BaseGenerationJob):
+    """多线程批量生成任务
+
+    去重后的请求按 chunk_size 切成小批放入共享工作队列，空闲的工作线程随时领取
+    下一批，避免某个线程分到大量长文本时其他线程早早闲置。
+    """
+    def __init__(self, engine, df, ref_columns, num_threads=4, chunk_size=1, rows=None,
+                 checkpoint=None, pack_size=1, warm_up=False):
+        super().__init__(engine, df, ref_columns, rows, checkpoint, pack_size, warm_up)
+        self.num_threads = max(1, num_threads)
+        self.chunk_size = max(1, chunk_size)
+
+        self.work_queue = queue.Queue()
+        self.threads = []
+
+    def start(self):
+        """将去重后的请求分批放入工作队列并启动工作线程"""
+        batch_size = self.chunk_size * self.pack_size  # 每批包含 chunk_size 个合并批次
+        for start_idx in range(0, self.total_requests, batch_size):
+            self.work_queue.put(self.groups[start_idx:start_idx + batch_size])
+
+        # 线程数不超过批次数，避免创建无事可做的线程
+        num_workers = max(1, min(self.num_threads, self.work_queue.qsize()))
+        for _ in range(num_workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True  # 设置为守护线程
+            self.threads.append(thread)
+
+        # 启动所有工作线程
+        for thread in self.threads:
+            thread.start()
+
+    def is_running(self):
+        """是否还有工作线程在运行"""
+        return any(t.is_alive() for t in self.threads)
+
+    def worker(self):
+        """工作线程主循环：不断领取下一批行，直到队列为空"""
+        self.warm_up_model()
+        while True:
+            try:
+                groups = self.work_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.process_groups(groups)
+
+    def process_groups(self, groups):
+        """处理一批请求（在工作线程中运行）"""
+        try:
+            for pack in self.iter_packs(groups):
+                self.request_started()
+                if len(pack) > 1:
+                    try:
+                        contents = self.engine.generate_packed([prompt for prompt, _ in pack])
+                    except Exception as e:
+                        self.record_pack_failure(pack, AIRequestError.from_exception(e))
+                        continue
+                    if contents is not None:
+                        self.record_pack_results(pack, contents)
+                        continue
+                # 未合并或合并结果无法解析时逐行请求
+                for prompt, members in pack:
+                    try:
+                        generated_content = self.engine.generate_prompt(prompt)
+                    except Exception as e:
+                        self.record_group_failure(members, AIRequestError.from_exception(e))
+                        continue
+                    self.record_group_result(members, generated_content)
+        except Exception as e:
+            # 将异常信息加入结果队列
+            self.result_queue.put(("ERROR", str(e)))
+
+
+class AsyncGenerationJob(BaseGenerationJob):
+    """基于asyncio的批量生成任务
+
+    在单个后台线程中运行事件循环，由 max_in_flight 个协程从共享的请求迭代器中取出并
+    发起请求，因此同时在途的请求数不会超过 max_in_flight。适合面向远程
+    OpenAI兼容接口的大任务：并发可达数百而无需同样数量的系统线程。
+    与 GenerationJob 使用相同的队列和失败记录约定。
+    """
+    def __init__(self, engine, df, ref_columns, max_in_flight=100, rows=None, checkpoint=None,
+                 pack_size=1, warm_up=False):
+        super().__init__(engine, df, ref_columns, rows, checkpoint, pack_size, warm_up)
+        self.max_in_flight = max(1, max_in_flight)
+        self.thread = None
+
+    def start(self):
+        """启动事件循环线程"""
+        self.thread = threading.Thread(target=self.run_event_loop)
+        self.thread.daemon = True  # 设置为守护线程
+        self.thread.start()
+
+    def is_running(self):
+        """事件循环线程是否仍在运行"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def run_event_loop(self):
+        """事件循环线程入口"""
+        try:
+            asyncio.run(self.run())
+        except Exception as e:
+            # 将异常信息加入结果队列
+            self.result_queue.put(("ERROR", str(e)))
+
+    async def run(self):
+        """启动固定数量的协程处理所有请求"""
+        # 模型预热和接口池的首次健康检查都是阻塞调用，放到线程池中执行，不阻塞事件循环；
+        # 预热时已启动接口池的话 start 不再重复检查
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.warm_up_model)
+        if self.engine.endpoints is not None:
+            await loop.run_in_executor(None, self.engine.endpoints.start)
+        packs = list(self.iter_packs(self.groups))
+        num_workers = max(1, min(self.max_in_flight, len(packs)))
+        packs = iter(packs)
+        try:
+            await asyncio.gather(*[self.worker(packs) for _ in range(num_workers)])
+        finally:
+            await self.engine.aclose()
+
+    async def worker(self, packs):
+        """协程主循环：从共享迭代器取下一个合并批次直到取完"""
+        for pack in packs:
+            self.request_started()
+            if len(pack) > 1:
+                try:
+                    contents = await self.engine.agenerate_packed([prompt for prompt, _ in pack])
+                except Exception as e:
+                    self.record_pack_failure(pack, AIRequestError.from_exception(e))
+                    continue
+                if contents is not None:
+                    self.record_pack_results(pack, contents)
+                    continue
+            for prompt, members in pack:
+                try:
+                    generated_content = await self.engine.agenerate_prompt(prompt)
+                except Exception as e:
+                    self.record_group_failure(members, AIRequestError.from_exception(e))
+                    continue
+                self.record_group_result(members, generated_content)
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import threading
+import time
+from ai_engine import BaseGenerationJob, AIRequestError, build_system_message
+
+# OpenAI Batch API离线批处理：把所有提示词写成Batch API的JSONL请求文件上传，服务端在
+# 24小时内完成，费用约为实时调用的一半且不占用实时接口的限额，适合不着急的大任务。
+# 提交后批处理ID等信息保存在输入文件旁，程序退出后可以继续轮询并取回结果。
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+MAX_POLL_ERRORS = 5  # 连续查询状态失败多少次后放弃
+# Batch API对每个批处理的限制：最多50000条请求、输入文件最大200MB，超出时拆成多个批处理
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+
+def batch_state_path_for(input_path):
+    """输入文件对应的批处理状态文件路径"""
+    return f"{input_path}.batch.json"
+
+
+def batch_requests_path_for(input_path):
+    """输入文件对应的批处理请求文件路径(即上传的JSONL文件，保留一份便于检查)"""
+    return f"{input_path}.batch_requests.jsonl"
+
+
+def load_batch_state(path):
+    """读取批处理状态文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_batch_state(path, state):
+    """保存批处理状态文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+
+
+def state_batches(state):
+    """状态文件中的批处理列表 [{"batch_id", "input_file_id", "requests"}]，兼容只记录一个批处理的旧格式"""
+    if "batches" in state:
+        return state["batches"]
+    return [{"batch_id": state["batch_id"], "input_file_id": state.get("input_file_id"),
+             "requests": state["requests"]}]
+
+
+def split_requests(lines, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """把 (请求序号, JSONL行) 列表按条数和文件大小上限拆分，返回 [(请求序号列表, 文件内容)]"""
+    chunks = []
+    indexes, parts, size = [], [], 0
+    for i, line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if parts and (len(parts) >= max_requests or size + line_size > max_bytes):
+            chunks.append((indexes, "\n".join(parts) + "\n"))
+            indexes, parts, size = [], [], 0
+        indexes.append(i)
+        parts.append(line)
+        size += line_size
+    if parts:
+        chunks.append((indexes, "\n".join(parts) + "\n"))
+    return chunks
+
+
+class OpenAIBatchJob(BaseGenerationJob):
+    """通过OpenAI Batch API离线处理的生成任务
+
+    与 GenerationJob 使用相同的队列和失败记录约定，可以直接交给命令行的进度循环。
+    后台线程依次完成：命中响应缓存的请求直接写回；其余去重后的请求写成JSONL，超过
+    Batch API的条数或文件大小上限时拆成多个文件，逐个上传并创建批处理，每创建一个就
+    把批处理列表保存到 state_path；之后每 poll_interval 秒查询一次各批处理的状态，
+    哪个结束就下载它的结果文件和错误文件，按 custom_id 把结果分发到对应的行。服务端
+    没有返回结果的请求记为失败，之后可以用 --retry-errors 重跑。
+
+    resume 为True时不再提交，而是继续轮询状态文件中记录的批处理；此时 rows 必须与
+    提交时相同，提示词有变化时报错。status_message 为当前阶段的说明，供进度显示。
+    传入 requests_path 时把上传的JSONL请求另存一份(多个批处理依次写在同一文件中)。
+    """
+    def __init__(self, engine, df, ref_columns, rows=None, checkpoint=None, state_path=None,
+                 requests_path=None, resume=False, poll_interval=60, completion_window="24h"):
+        super().__init__(engine, df, ref_columns, rows, checkpoint)
+        self.state_path = state_path
+        self.requests_path = requests_path
+        self.resume = resume
+        self.batches = []  # [{"batch_id", "input_file_id", "requests"}]
+        self.poll_interval = max(1, poll_interval)
+        self.completion_window = completion_window
+        self.thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """启动后台线程"""
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True  # 设置为守护线程
+        self.thread.start()
+
+    def is_running(self):
+        """后台线程是否仍在运行"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        """停止轮询(批处理仍在服务端继续运行)"""
+        self._stop_event.set()
+
+    def custom_id(self, group_index):
+        """请求的custom_id，按去重后请求的序号生成"""
+        return f"request-{group_index}"
+
+    def prompts_digest(self, group_indexes):
+        """提交的提示词摘要，继续轮询时用来确认输入和模板没有变化"""
+        digest = hashlib.sha256()
+        for i in group_indexes:
+            digest.update(self.groups[i][0].encode('utf-8'))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def build_requests(self, group_indexes):
+        """生成Batch API的JSONL请求，返回 [(请求序号, JSONL行)]"""
+        lines = []
+        for i in group_indexes:
+            prompt = self.groups[i][0]
+            body = {
+                "model": self.engine.model,
+                "messages": self.engine.build_messages(prompt, build_system_message(prompt)),
+            }
+            body.update(self.engine.sampling_params())
+            lines.append((i, json.dumps({"custom_id": self.custom_id(i), "method": "POST",
+                                         "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False)))
+        return lines
+
+    def run(self):
+        """后台线程入口"""
+        try:
+            client = self.engine.get_openai_client()
+            if not self.resume:
+                pending = self.record_cached_groups(range(self.total_requests))
+                if not pending:
+                    return
+                self.submit(client, pending)
+            else:
+                state = load_batch_state(self.state_path)
+                self.batches = state_batches(state)
+                submitted = [i for batch in self.batches for i in batch["requests"]]
+                if state.get("digest") != self.prompts_digest(submitted):
+                    raise ValueError("输入文件、模板或模型与提交批处理时不同，无法合并结果")
+                submitted_set = set(submitted)
+                missing = self.record_cached_groups(
+                    [i for i in range(self.total_requests) if i not in submitted_set])
+                for i in missing:
+                    self.record_group_failure(self.groups[i][1], AIRequestError(
+                        "该请求不在已提交的批处理中(提交时命中的缓存已失效或提交中断)，请重新运行"))
+
+            self.wait_for_batches(client)
+        except Exception as e:
+            # 将异常信息加入结果队列
+            self.result_queue.put(("ERROR", str(e)))
+
+    def record_cached_groups(self, group_indexes):
+        """命中响应缓存的请求直接写回，返回未命中的请求序号"""
+        pending = []
+        for i in group_indexes:
+            prompt, members = self.groups[i]
+            cached = None
+            if self.engine.cache is not None:
+                cached = self.engine.cache.get(self.engine.cache_key(prompt, build_system_message(prompt)))
+            if cached is None:
+                pending.append(i)
+            else:
+                self.record_group_result(members, self.engine.clean_output(cached))
+        return pending
+
+    def submit(self, client, group_indexes):
+        """按Batch API的上限拆分请求，逐个上传并创建批处理，每创建一个保存一次状态文件"""
+        chunks = split_requests(self.build_requests(group_indexes), MAX_BATCH_REQUESTS, MAX_BATCH_BYTES)
+        if self.requests_path:
+            with open(self.requests_path, 'w', encoding='utf-8') as f:
+                for _, content in chunks:
+                    f.write(content)
+        created = time.strftime("%Y-%m-%d %H:%M:%S")
+        for number, (indexes, content) in enumerate(chunks, 1):
+            self.status_message = f"正在上传第 {number}/{len(chunks)} 个批处理({len(indexes)} 条请求)"
+            input_file = client.files.create(file=("batch_requests.jsonl", content.encode('utf-8')),
+                                             purpose="batch")
+            batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                          completion_window=self.completion_window)
+            self.batches.append({"batch_id": batch.id, "input_file_id": input_file.id,
+                                 "requests": indexes})
+            if self.state_path:
+                submitted = [i for item in self.batches for i in item["requests"]]
+                save_batch_state(self.state_path, {
+                    "batches": self.batches,
+                    "model": self.engine.model,
+                    "rows": self.rows,
+                    "digest": self.prompts_digest(submitted),
+                    "created": created,
+                })
+        self.status_message = f"已提交 {len(self.batches)} 个批处理"
+
+    def wait_for_batches(self, client):
+        """轮询所有批处理直到结束，每个批处理结束时合并它的结果；调用 stop() 后返回"""
+        pending = list(self.batches)
+        errors = 0
+        while pending:
+            messages = []
+            for item in list(pending):
+                batch_id = item["batch_id"]
+                try:
+                    batch = client.batches.retrieve(batch_id)
+                    errors = 0
+                except Exception as e:
+                    # 长时间轮询中偶尔的网络错误不影响服务端的批处理，稍后再查
+                    errors += 1
+                    if errors >= MAX_POLL_ERRORS:
+                        raise
+                    messages.append(f"查询批处理 {batch_id} 状态失败，稍后重试: {str(e)}")
+                    continue
+                if batch.status in FINAL_STATUSES:
+                    self.merge_results(client, batch, item["requests"])
+                    pending.remove(item)
+                    continue
+                counts = batch.request_counts
+                progress = f"，已完成 {counts.completed}/{counts.total}" if counts is not None else ""
+                messages.append(f"批处理 {batch_id} 状态: {batch.status}{progress}")
+            finished = len(self.batches) - len(pending)
+            prefix = f"{finished}/{len(self.batches)} 个批处理已结束" if len(self.batches) > 1 else ""
+            self.status_message = "；".join(([prefix] if prefix else []) + messages)
+            if pending and self._stop_event.wait(self.poll_interval):
+                return
+
+    def read_result_file(self, client, file_id):
+        """下载结果文件或错误文件，返回 {custom_id: 记录}"""
+        records = {}
+        if not file_id:
+            return records
+        for line in client.files.content(file_id).text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                records[record["custom_id"]] = record
+        return records
+
+    def merge_results(self, client, batch, group_indexes):
+        """按custom_id把批处理结果分发到各行，没有结果的请求记为失败"""
+        records = self.read_result_file(client, batch.error_file_id)
+        records.update(self.read_result_file(client, batch.output_file_id))
+        for i in group_indexes:
+            prompt, members = self.groups[i]
+            record = records.get(self.custom_id(i))
+            try:
+                content = self.parse_record(record, batch.status)
+            except AIRequestError as e:
+                self.record_group_failure(members, e)
+                continue
+            if self.engine.cache is not None:
+                self.engine.cache.put(self.engine.cache_key(prompt, build_system_message(prompt)), content)
+            self.record_group_result(members, self.engine.clean_output(content))
+
+    def parse_record(self, record, batch_status):
+        """从一条批处理结果中取出原始输出，失败时抛出AIRequestError"""
+        if record is None:
+            raise AIRequestError(f"批处理结束(状态: {batch_status})但没有返回该请求的结果")
+        if record.get("error"):
+            error = record["error"]
+            raise AIRequestError(f"批处理请求失败: {error.get('message') or error.get('code')}")
+        response = record.get("response") or {}
+        status_code = response.get("status_code")
+        if status_code != 200:
+            body = response.get("body") or {}
+            message = (body.get("error") or {}).get("message", "")
+            raise AIRequestError(f"批处理请求返回状态码 {status_code} {message}".strip(), status_code)
+        message = response["body"]["choices"][0]["message"]
+        if not message.get("content"):
+            refusal = message.get("refusal")
+            raise AIRequestError(f"模型拒绝回答: {refusal}" if refusal else "模型返回了空内容")
+        return message["content"]
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+
+from table_io import ensure_text_column
+
+# 长任务的检查点：生成结果逐行追加到输入文件旁的JSON Lines文件，
+# 程序崩溃或窗口被关闭后可以从检查点继续，不必重新请求已完成的行
+
+
+def checkpoint_path_for(input_path):
+    """输入文件对应的检查点文件路径"""
+    return f"{input_path}.checkpoint.jsonl"
+
+
+def checkpoint_signature(prompt_template, model, ref_columns=()):
+    """模板、模型和引用列的摘要，记录在检查点第一行，任一项变化后旧检查点不再使用"""
+    text = json.dumps([model, prompt_template, list(ref_columns)], ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def load_checkpoint(path, target_column, signature=None):
+    """读取检查点，返回 {行位置: 生成内容}
+
+    检查点属于其他写入列，或传入的 signature 与检查点记录的不同(模板、模型或引用列已变化)
+    时返回空字典；最后一行可能因崩溃只写了一半，解析失败的行直接跳过。
+    """
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if line_number == 0:
+                if record.get("target") != target_column:
+                    return {}
+                if signature is not None and record.get("signature") != signature:
+                    return {}
+                continue
+            completed[record["row"]] = record["content"]
+    return completed
+
+
+class CheckpointWriter:
+    """追加写入检查点文件（线程安全）
+
+    第一行记录写入列和 signature(见 checkpoint_signature)，之后每行是 {"row": 行位置, "content": 生成内容}。
+    每积累 flush_every 行写入并刷新一次文件，close() 时写入剩余的行。
+    append 为True时在已有检查点后继续追加(用于继续上次的任务)。
+    """
+    def __init__(self, path, target_column, flush_every=10, append=False, signature=None):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self._buffer = []
+        self._lock = threading.Lock()
+
+        has_header = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'a' if has_header else 'w', encoding='utf-8')
+        if not has_header:
+            header = {"target": target_column, "signature": signature}
+            self._file.write(json.dumps(header, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def write(self, position, content):
+        """记录一行的生成结果"""
+        line = json.dumps({"row": int(position), "content": content}, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                return
+            self._buffer.append(line)
+            if len(self._buffer) >= self.flush_every:
+                self._flush_locked()
+
+    def flush(self):
+        """把缓冲的行写入磁盘"""
+        with self._lock:
+            if self._file is not None:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        self._file.writelines(self._buffer)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer = []
+
+    def close(self):
+        """写入剩余的行并关闭文件"""
+        with self._lock:
+            if self._file is not None:
+                self._flush_locked()
+                self._file.close()
+                self._file = None
+
+
+def apply_checkpoint(df, target_column, completed, rows=None):
+    """把检查点中的结果写回数据框，返回仍需处理的行位置列表"""
+    ensure_text_column(df, target_column)
+    for position, content in completed.items():
+        if position < len(df):
+            df.at[df.index[position], target_column] = content
+    if rows is None:
+        rows = range(len(df))
+    return [position for position in rows if position not in completed]
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+# 行指纹：对每行的引用列内容、提示词模板和模型取哈希，保存在表格文件旁的JSON文件中。
+# 增量模式下只处理写入列为空或指纹发生变化的行，适合每天追加少量新行的大表
+
+
+def fingerprint_path_for(table_path):
+    """表格文件对应的指纹文件路径"""
+    return f"{table_path}.fingerprints.json"
+
+
+def compute_fingerprints(df, ref_columns, prompt_template, model):
+    """按行位置计算指纹列表"""
+    base = json.dumps([model, prompt_template, list(ref_columns)], ensure_ascii=False)
+    fingerprints = []
+    for values in zip(*[df[col].tolist() for col in ref_columns]):
+        text = base + "\x00" + "\x1f".join(str(value) for value in values)
+        fingerprints.append(hashlib.sha1(text.encode('utf-8')).hexdigest()[:16])
+    return fingerprints
+
+
+def load_fingerprints(path, target_column):
+    """读取指定写入列上次保存的指纹列表，没有时返回空列表"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get(target_column, [])
+
+
+def save_fingerprints(path, target_column, fingerprints):
+    """保存写入列的指纹列表，同一文件中其他写入列的指纹保持不变"""
+    data = {}
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            data = {}
+    data[target_column] = fingerprints
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def is_empty_cell(value):
+    """单元格是否为空(NaN或空白字符串)"""
+    return pd.isna(value) or str(value).strip() == ""
+
+
+def select_changed_rows(df, target_column, current, previous, rows=None):
+    """返回写入列为空或指纹与上次不同的行位置"""
+    if rows is None:
+        rows = range(len(df))
+    has_target = target_column in df.columns
+    target_values = df[target_column].tolist() if has_target else []
+    changed = []
+    for position in rows:
+        if (position >= len(previous) or previous[position] != current[position]
+                or not has_target or is_empty_cell(target_values[position])):
+            changed.append(position)
+    return changed
+
+
+def update_fingerprints(previous, current, processed_positions):
+    """合并出本次运行后应保存的指纹
+
+    本次成功生成的行和指纹未变的行记为新指纹；其余行(失败或未处理且已变化)保留上次的
+    指纹，下次增量运行时仍会被选中。
+    """
+    processed = set(processed_positions)
+    merged = []
+    for position, fingerprint in enumerate(current):
+        old = previous[position] if position < len(previous) else None
+        merged.append(fingerprint if position in processed or old == fingerprint else old)
+    return merged
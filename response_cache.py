@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# 本地持久化响应缓存：相同的服务、模型、系统提示词、提示词和采样参数直接复用上次的AI输出，
+# 重新运行同一模板时无需再次调用模型
+
+DEFAULT_CACHE_PATH = "response_cache.db"
+
+
+def make_cache_key(api_type, model, system_message, prompt, params=None):
+    """计算缓存键：对服务类型、模型、系统提示词、渲染后的提示词和采样参数取SHA-256"""
+    payload = json.dumps([api_type, model, system_message, prompt, params or {}],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """基于SQLite的响应缓存（线程安全）
+
+    保存的是清理前的原始输出，修改清理规则后缓存仍然有效。超过 max_age_days 天的
+    条目视为过期；条目数超过 max_entries 时按最近使用时间淘汰最旧的条目。
+    hits/misses 记录本缓存对象的命中和未命中次数，供进度窗口和命令行显示。
+    """
+    EVICT_INTERVAL = 500  # 每写入多少条检查一次容量
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=100000, max_age_days=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        """查询缓存，未命中或已过期时返回None"""
+        return self.get_first([key])
+
+    def get_first(self, keys):
+        """按顺序查询多个键，返回第一个命中的内容，只计一次命中或未命中"""
+        now = time.time()
+        with self._lock:
+            if self._conn is None:  # 已关闭(任务中途出错时可能仍有工作线程在运行)
+                return None
+            for key in keys:
+                row = self._conn.execute(
+                    "SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None or (self.max_age and now - row[1] > self.max_age):
+                    continue
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, content):
+        """写入一条缓存"""
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, content, now, now))
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % self.EVICT_INTERVAL == 0:
+                self._evict_locked()
+
+    def evict(self):
+        """删除过期条目，并把条目数压缩到 max_entries 以内"""
+        with self._lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        if self.max_age:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        if self.max_entries:
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,))
+        self._conn.commit()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats_text(self):
+        """命中统计的显示文本"""
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"缓存命中 {self.hits}，未命中 {self.misses} (命中率 {rate:.0f}%)"
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
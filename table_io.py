@@ -0,0 +1,354 @@
+import os
+import pandas as pd
+# chardet会在需要时动态导入
+
+# 表格文件读写：图形界面和命令行共用的编码检测与导入导出逻辑
+
+FALLBACK_ENCODINGS = ['utf-8', 'utf-8-sig', 'gbk', 'gb2312', 'cp936', 'latin1']
+
+# 编码检测时逐个验证的候选编码：gb18030是gbk/gb2312/cp936的超集，latin1总能解码，放在最后兜底
+CANDIDATE_ENCODINGS = ['utf-8', 'gb18030', 'latin1']
+
+SAMPLE_SIZE = 64 * 1024  # 每个采样区域读取的字节数
+
+# 编码检测结果缓存 {(绝对路径, 文件大小, 修改时间): (编码, 置信度)}
+_encoding_cache = {}
+
+
+def read_samples(file_path, sample_size=SAMPLE_SIZE):
+    """读取文件开头、中间和结尾三段字节用于编码检测
+
+    中间和结尾的采样对齐到换行符，避免从多字节字符中间截断；小文件直接整体读取。
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        if size <= sample_size * 3:
+            return [f.read()]
+
+        samples = []
+        for offset in (0, size // 2, size - sample_size):
+            f.seek(offset)
+            data = f.read(sample_size)
+            if offset > 0:
+                data = data[data.find(b'\n') + 1:]
+            if offset + sample_size < size:
+                data = data[:data.rfind(b'\n') + 1]
+            samples.append(data)
+        return samples
+
+
+def decodes_all(samples, encoding):
+    """所有采样是否都能用该编码解码"""
+    try:
+        for data in samples:
+            data.decode(encoding)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def detect_csv_encoding(file_path):
+    """检测CSV文件编码，返回(编码, 置信度)，置信度未知时为None
+
+    只读取文件开头、中间和结尾的采样，先用chardet给出候选，再与常见编码一起在所有采样上
+    验证，取第一个全部解码成功的编码。结果按(路径, 大小, 修改时间)缓存，同一文件不会重复检测。
+    """
+    stat = os.stat(file_path)
+    cache_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    if cache_key in _encoding_cache:
+        return _encoding_cache[cache_key]
+
+    # 先尝试使用二进制模式读取文件头部，检测BOM标记
+    with open(file_path, 'rb') as f:
+        raw_data = f.read(4)
+
+    # 检查是否有UTF-8 BOM标记 (EF BB BF)
+    if raw_data.startswith(b'\xef\xbb\xbf'):
+        result = ('utf-8-sig', None)
+    else:
+        samples = read_samples(file_path)
+        candidates = list(CANDIDATE_ENCODINGS)
+        confidence = None
+        try:
+            import chardet
+            # chardet是纯Python实现，每段只取前16KB，避免大采样拖慢检测
+            detected = chardet.detect(b''.join(data[:16 * 1024] for data in samples))
+            if detected['encoding']:
+                # chardet把中文CSV识别为GB2312时常遇到超出其字符集的字，统一换成超集gb18030
+                encoding = detected['encoding'].lower()
+                if encoding in ('gb2312', 'gbk', 'cp936'):
+                    encoding = 'gb18030'
+                if encoding != 'ascii':
+                    candidates.insert(0, encoding)
+                confidence = detected['confidence']
+        except ImportError:
+            # 如果没有安装chardet，则只验证常见编码
+            pass
+
+        result = ('latin1', None)
+        for encoding in candidates:
+            if decodes_all(samples, encoding):
+                result = (encoding, confidence if encoding == candidates[0] else None)
+                break
+
+    _encoding_cache[cache_key] = result
+    return result
+
+
+def read_csv_auto(file_path, encoding=None, **kwargs):
+    """自动检测编码读取CSV文件，返回(DataFrame, 实际使用的编码)
+
+    编码由采样检测确定，整个文件只完整解析一次；只有采样之外的位置出现无法解码的字节时，
+    才依次尝试其他常见编码。其余关键字参数(如 usecols、nrows)传给 pd.read_csv。
+    """
+    if not encoding:
+        encoding, _ = detect_csv_encoding(file_path)
+
+    # 使用检测到的编码打开CSV文件
+    try:
+        return pd.read_csv(file_path, encoding=encoding, **kwargs), encoding
+    except UnicodeDecodeError as e:
+        # 如果还是失败，尝试其他编码
+        # 确保不重复尝试已失败的编码
+        encodings_to_try = [enc for enc in FALLBACK_ENCODINGS if enc != encoding]
+
+        for enc in encodings_to_try:
+            try:
+                return pd.read_csv(file_path, encoding=enc, **kwargs), enc
+            except UnicodeDecodeError:
+                continue
+            except Exception as specific_error:
+                # 记录特定编码的错误，但继续尝试其他编码
+                print(f"使用 {enc} 编码读取时出错: {str(specific_error)}")
+
+        raise ValueError(f"无法自动检测文件编码，原始错误: {str(e)}")
+
+
+# 使用openpyxl只读模式流式读取的Excel格式(.xls仍由pandas读取)
+EXCEL_STREAMING_EXTENSIONS = ('.xlsx', '.xlsm')
+
+# 列式格式：Parquet和Arrow IPC(Feather)，读写需要pyarrow
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+FEATHER_EXTENSIONS = ('.feather', '.arrow')
+COLUMNAR_EXTENSIONS = PARQUET_EXTENSIONS + FEATHER_EXTENSIONS
+
+
+def import_pyarrow():
+    """pyarrow只在读写Parquet/Feather文件时导入，未安装时给出提示"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("读写Parquet/Feather文件需要安装pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def prepare_for_arrow(df):
+    """把混合类型的文本列(如Excel中数字和文字混排的列)转为字符串，Arrow要求每列类型一致"""
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed"):
+            df[col] = df[col].map(lambda value: value if pd.isna(value) else str(value))
+    return df
+
+
+def excel_header_names(header):
+    """按pandas的规则生成列名：空表头为 Unnamed: 序号，重复列名加 .1、.2 后缀"""
+    names = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def read_excel_streaming(file_path, columns=None, nrows=None, progress=None, progress_every=10000):
+    """用openpyxl只读模式逐行读取第一个工作表，只保留需要的列
+
+    不构建整个工作簿的对象模型，逐行把需要的单元格追加到列数组中，最后一次性生成DataFrame。
+    progress(已读行数, 总行数) 每读取 progress_every 行调用一次，总行数未知时为None。
+    """
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        names = excel_header_names(next(rows, None) or ())
+        if columns is None:
+            selected = list(range(len(names)))
+        else:
+            missing = [col for col in columns if col not in names]
+            if missing:
+                raise ValueError(f"列不存在: {', '.join(str(col) for col in missing)}")
+            selected = [names.index(col) for col in columns]
+
+        data = [[] for _ in selected]
+        total = sheet.max_row - 1 if sheet.max_row else None
+        count = 0
+        last_nonempty = 0  # 末尾的空行(只有格式的行)不计入数据
+        for row in rows:
+            if nrows is not None and count >= nrows:
+                break
+            for values, idx in zip(data, selected):
+                values.append(row[idx] if idx < len(row) else None)
+            count += 1
+            if any(value is not None for value in row):
+                last_nonempty = count
+            if progress is not None and count % progress_every == 0:
+                progress(count, total)
+
+        if progress is not None:
+            progress(last_nonempty, last_nonempty)
+        return pd.DataFrame({names[idx]: values[:last_nonempty] for idx, values in zip(selected, data)},
+                            columns=[names[idx] for idx in selected])
+    finally:
+        workbook.close()
+
+
+def read_table(file_path, encoding=None, columns=None, progress=None):
+    """根据扩展名读取Excel或CSV文件，返回(DataFrame, 编码)，Excel文件编码为None
+
+    指定 columns 时只读取这些列(按给定顺序)；progress 为.xlsx文件的读取进度回调。
+    """
+    if file_path.lower().endswith('.csv'):
+        df, encoding = read_csv_auto(file_path, encoding, usecols=columns)
+    elif file_path.lower().endswith(EXCEL_STREAMING_EXTENSIONS):
+        df, encoding = read_excel_streaming(file_path, columns, progress=progress), None
+    elif file_path.lower().endswith(PARQUET_EXTENSIONS):
+        import_pyarrow()
+        df, encoding = pd.read_parquet(file_path, columns=columns), None
+    elif file_path.lower().endswith(FEATHER_EXTENSIONS):
+        import_pyarrow()
+        df, encoding = pd.read_feather(file_path, columns=columns), None
+    else:
+        df, encoding = pd.read_excel(file_path, usecols=columns), None
+    if columns is not None:
+        df = df[list(columns)]
+    return df, encoding
+
+
+def read_table_columns(file_path, encoding=None):
+    """只读取表头，返回(列名列表, 编码)"""
+    if file_path.lower().endswith('.csv'):
+        df, encoding = read_csv_auto(file_path, encoding, nrows=0)
+        return df.columns.tolist(), encoding
+    if file_path.lower().endswith(EXCEL_STREAMING_EXTENSIONS):
+        return read_excel_streaming(file_path, nrows=0).columns.tolist(), None
+    if file_path.lower().endswith(COLUMNAR_EXTENSIONS):
+        # 列式格式的表头在文件元数据中，不需要读取任何数据
+        pyarrow = import_pyarrow()
+        if file_path.lower().endswith(PARQUET_EXTENSIONS):
+            names = pyarrow.parquet.read_schema(file_path).names
+        else:
+            with pyarrow.memory_map(file_path) as source:
+                names = pyarrow.ipc.open_file(source).schema.names
+        # 跳过pandas写入的索引列
+        return [name for name in names if not name.startswith("__index_level_")], None
+    return pd.read_excel(file_path, nrows=0).columns.tolist(), None
+
+
+class ProjectedTable:
+    """按列投影加载的表格
+
+    打开时只读取表头和第一列(用于确定行数)，之后按需用 usecols 加载生成任务用到的
+    引用列和写入列。df 只包含已加载的列和新建的列，导出时 merged() 再读取完整文件，
+    把 df 中的列合并回去。CSV、Parquet和Feather文件可以只解析用到的列，宽表的加载
+    时间和内存占用因此只与用到的列数有关。
+
+    .xlsx 文件不做投影：openpyxl只读模式读取任意几列都要解析整个工作表，因此打开时
+    一次读入全部列保存在 source 中，加载时间和内存与整表读取相同，但只读取一次。
+    """
+    def __init__(self, file_path, encoding=None, progress=None):
+        self.file_path = file_path
+        self.progress = progress  # Excel读取进度回调
+        self.source = None  # 一次读入的完整表格(.xlsx)，其他格式为None
+        if file_path.lower().endswith(EXCEL_STREAMING_EXTENSIONS):
+            # openpyxl只读模式无论保留几列都要解析整个工作表，一次读入全部列并保留，
+            # 行数也由这次读取得到，之后加载列和导出都不再读取文件
+            self.source, self.encoding = read_table(file_path, progress=progress)
+            self.columns = self.source.columns.tolist()
+            self.df = self.source[self.columns[:1]].copy()
+            return
+        self.columns, self.encoding = read_table_columns(file_path, encoding)
+        self.df, self.encoding = read_table(file_path, self.encoding, columns=self.columns[:1],
+                                            progress=progress)
+
+    def read_columns(self, columns):
+        """读取源文件中的指定列"""
+        if self.source is not None:
+            return self.source[columns]
+        loaded, _ = read_table(self.file_path, self.encoding, columns=columns, progress=self.progress)
+        return loaded
+
+    def load_columns(self, columns):
+        """加载尚未加载的源文件列，直接写入 df(保持 df 对象不变)"""
+        missing = [col for col in columns if col in self.columns and col not in self.df.columns]
+        if not missing:
+            return
+        loaded = self.read_columns(missing)
+        for col in missing:
+            self.df[col] = loaded[col].values
+
+    def all_columns(self):
+        """源文件的全部列加上新建的列"""
+        return self.columns + [col for col in self.df.columns if col not in self.columns]
+
+    def merged(self):
+        """读取完整文件并合并 df 中的列，用于导出"""
+        if self.source is not None:
+            full = self.source.copy()
+        else:
+            full, _ = read_table(self.file_path, self.encoding, progress=self.progress)
+        for col in self.df.columns:
+            full[col] = self.df[col].values
+        return full
+
+
+def ensure_text_column(df, column):
+    """确保写入列存在且为object类型，写入生成结果前调用
+
+    文件中已有但全部为空的列读入后是float64(全为NaN)，新版pandas不允许向其中写入字符串。
+    """
+    if column not in df.columns:
+        df[column] = ""
+    if df[column].dtype != object:
+        df[column] = df[column].astype(object)
+
+
+def write_table(df, file_path, encoding='utf-8-sig'):
+    """根据扩展名导出Excel、CSV、Parquet或Feather文件"""
+    if file_path.lower().endswith('.csv'):
+        df.to_csv(file_path, index=False, encoding=encoding)
+    elif file_path.lower().endswith(PARQUET_EXTENSIONS):
+        import_pyarrow()
+        prepare_for_arrow(df.copy()).to_parquet(file_path, index=False)
+    elif file_path.lower().endswith(FEATHER_EXTENSIONS):
+        import_pyarrow()
+        prepare_for_arrow(df.reset_index(drop=True)).to_feather(file_path)
+    else:
+        df.to_excel(file_path, index=False)
+
+
+def iter_csv_chunks(file_path, chunk_rows, encoding=None, skip_rows=0):
+    """分块读取CSV文件，返回(编码, 分块迭代器)，skip_rows 为跳过的数据行数(不含表头)"""
+    if not encoding:
+        encoding, _ = detect_csv_encoding(file_path)
+    reader = pd.read_csv(file_path, encoding=encoding, chunksize=chunk_rows,
+                         skiprows=range(1, skip_rows + 1))
+    return encoding, reader
+
+
+def append_csv(df, file_path, encoding='utf-8-sig', header=False):
+    """把一块数据追加到CSV文件，header为True时新建文件并写入表头"""
+    df.to_csv(file_path, mode='w' if header else 'a', header=header, index=False, encoding=encoding)
+
+
+def count_csv_rows(file_path, encoding='utf-8-sig', chunk_rows=100000):
+    """分块统计CSV文件的数据行数(不含表头)"""
+    return sum(len(chunk) for chunk in pd.read_csv(file_path, encoding=encoding, usecols=[0],
+                                                    chunksize=chunk_rows))